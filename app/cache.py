@@ -0,0 +1,188 @@
+import pickle
+import time
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from .config import settings
+
+# read-through cache for single entity lookups
+#
+# Cached values are plain dicts of column values, not ORM instances, since
+# ORM instances belong to the session that loaded them. A cache hit rebuilds
+# a detached instance from the dict, see `to_cache` and `from_cache`.
+#
+# Entries are invalidated by the CRUD write functions after commit, and
+# expire after `CACHE_TTL_SECONDS` in any case. With several uvicorn workers,
+# each worker has its own local cache and only sees its own invalidations,
+# use a shared backend to invalidate across workers.
+
+
+# Cache backend interface, methods are async so that network backends such
+# as redis or memcached can be plugged in.
+class CacheBackend:
+    async def get(self, key: str):
+        raise NotImplementedError
+
+    async def set(self, key: str, value, ttl: float):
+        raise NotImplementedError
+
+    async def delete(self, *keys: str):
+        raise NotImplementedError
+
+    async def clear(self):
+        raise NotImplementedError
+
+
+# in-process LRU cache, bounded by number of entries, with per entry ttl
+class LRUCache(CacheBackend):
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    async def clear(self):
+        self._entries.clear()
+
+
+# Local stand-in for a shared cache backend, it behaves like a networked
+# store: values are serialized to bytes on set and deserialized on get, so
+# cached values never share state with the caller. Bounded by number of
+# entries, the oldest set entries are evicted first, as a store with a max
+# memory and an eviction policy would.
+class LocalSharedCache(CacheBackend):
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        return pickle.loads(data)
+
+    async def set(self, key: str, value, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, pickle.dumps(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    async def clear(self):
+        self._entries.clear()
+
+
+class Cache:
+    def __init__(self, backend: CacheBackend = None, ttl: float = 60):
+        # no backend disables caching
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # A load started before a write commits may finish after the write
+        # invalidated the key, and would cache the value read before the
+        # write. Invalidations are numbered, and a load only caches its value
+        # if the key wasn't invalidated since the load started. Only the keys
+        # being loaded are tracked.
+        self._invalidations = 0
+        self._loading = {}
+        self._invalidated_at = {}
+
+    # Return the cached value of key, or await loader() on a miss and cache
+    # its result. None results are not cached.
+    async def get_or_load(self, key: str, loader):
+        if self.backend is None:
+            return await loader()
+        value = await self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        started = self._invalidations
+        self._loading[key] = self._loading.get(key, 0) + 1
+        try:
+            value = await loader()
+            if value is not None and self._invalidated_at.get(key, -1) < started:
+                await self.backend.set(key, value, self.ttl)
+        finally:
+            self._loading[key] -= 1
+            if not self._loading[key]:
+                del self._loading[key]
+                self._invalidated_at.pop(key, None)
+        return value
+
+    async def invalidate(self, *keys: str):
+        if self.backend is not None and keys:
+            for key in keys:
+                if key in self._loading:
+                    self._invalidated_at[key] = self._invalidations
+            self._invalidations += 1
+            await self.backend.delete(*keys)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def create_cache_backend(name: str) -> CacheBackend:
+    if name == "local":
+        return LRUCache(max_size=settings.cache_max_size)
+    if name == "shared":
+        return LocalSharedCache(max_size=settings.cache_max_size)
+    return None
+
+
+cache = Cache(create_cache_backend(settings.cache_backend), settings.cache_ttl_seconds)
+
+
+def cache_key(model, id) -> str:
+    return f"{model.__tablename__}:{id}"
+
+
+# snapshot the column values of an orm instance, except the columns listed
+# in the model `__cache_exclude__`, such as secrets, which are left unloaded
+# in the rebuilt instance
+def to_cache(obj) -> dict:
+    mapper = inspect(obj).mapper
+    exclude = getattr(mapper.class_, "__cache_exclude__", ())
+    return {
+        attr.key: getattr(obj, attr.key)
+        for attr in mapper.column_attrs
+        if attr.key not in exclude
+    }
+
+
+# Rebuild an orm instance from cached column values. The instance is made
+# detached, as if it was loaded by a session that is now closed, so that
+# adding it to a session doesn't insert it again.
+def from_cache(model, data: dict):
+    obj = model(**data)
+    make_transient_to_detached(obj)
+    return obj
@@ -1,24 +1,41 @@
+from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm import aliased, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.future import select
 from sqlalchemy import delete as sa_delete
+from sqlalchemy import insert as sa_insert
+from sqlalchemy import update as sa_update
+from sqlalchemy import func, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import ValidationError
 from . import schemas
-from .models import Todo
-from .db import SessionLocal
-from .crud_user import get_user, get_users
+from .models import Todo, TodoTombstone, User
+from .db import ReadSessionLocal, engine, use_session
+from .crud_user import get_users, get_existing_user_ids, user_exists
+from .pagination import decode_cursor, decode_rank_cursor, paginate
+from .models_search import FULLTEXT_DIALECTS, fulltext_search
+from .cache import cache, cache_key, from_cache, to_cache
+from .models_crud import update_returning
+from .models_timestamp import naive_utc
+from .config import settings
 
 DEFAULT_LIMIT = 5
+# max number of items accepted by one bulk write request
+BULK_MAX_ITEMS = 1000
+# number of rows fetched and serialized at once by exports
+EXPORT_BATCH_SIZE = 1000
+EXPORT_COLUMNS = ["id", "owner_id", "text", "completed", "created_at", "updated_at"]
+# number of rows validated, inserted and committed at once by imports
+IMPORT_CHUNK_SIZE = 5000
+# max number of error details reported by an import
+IMPORT_MAX_ERRORS = 100
 
 
-# ! Note: this funcion shows an alternative way of requesting a db session
-# !       instead of using a FastAPI dependency injection.
-# See the get_todos(db: AsyncSession, ...) below for comparison.
-async def get_todo(id: str):
-    # use a separate `select .. in` query to eager load owner data
-    query = select(Todo).where(Todo.id == id).options(selectinload(Todo.owner))
-    async with SessionLocal() as db:
-        todos = await db.execute(query)
+# load a todo with its owner joined, in one statement
+async def load_todo(db: AsyncSession, id: str):
+    query = select(Todo).where(Todo.id == id).options(joinedload(Todo.owner))
+    todos = await db.execute(query)
     # AsyncResult.first() returns none if no row, or 1 element tuple
     todo = todos.first()
     if todo is not None:
@@ -26,24 +43,126 @@ async def get_todo(id: str):
     return todo
 
 
-async def get_todos(db: AsyncSession, offset: int = 0, limit: int = DEFAULT_LIMIT):
-    query = select(Todo).limit(limit).offset(offset)
+# ! Note: this funcion shows an alternative way of requesting a db session
+# !       instead of using a FastAPI dependency injection: it runs on the
+# !       session of the current request, see `db.use_session`, or on a
+# !       read session of its own, from a replica if any.
+# See the get_todos(db: AsyncSession, ...) below for comparison.
+#
+# Read-through cached version of `load_todo`. Only the todo column values are
+# cached, on a hit the owner is resolved through the cached `User.get`, so
+# that a user update invalidates the owner of its todos too. All statements
+# run on one session, which checks out one connection.
+async def get_todo(id: str):
+    async with use_session(ReadSessionLocal) as db:
+        loaded = None
+
+        async def loader():
+            nonlocal loaded
+            loaded = await load_todo(db, id)
+            return to_cache(loaded) if loaded else None
+
+        data = await cache.get_or_load(cache_key(Todo, id), loader)
+        if data is None:
+            return None
+        # on a miss, the todo was loaded with its owner
+        if loaded is not None:
+            return loaded
+        # rebuild a detached todo from the cache
+        todo = from_cache(Todo, data)
+        owner = await User.get(db, todo.owner_id, cached=True)
+    set_committed_value(todo, "owner", owner)
+    return todo
+
+
+# `filters` are `FilterMixin` conditions, e.g. `[("completed", "eq", True)]`,
+# and `sort` is a sort parameter, e.g. `"completed,-created_at"`, see
+# `pagination.py`
+async def get_todos(
+    db: AsyncSession,
+    offset: int = 0,
+    limit: int = DEFAULT_LIMIT,
+    after: str | None = None,
+    filters: list = None,
+    sort: str | None = None,
+):
+    query, params = Todo.build_query(filters or [])
+    query = paginate(query, Todo, after, sort=sort).limit(limit).offset(offset)
     # query = select(Todo).limit(limit).offset(offset).options(joinedload(Todo.owner))
-    todos = await db.execute(query)
+    todos = await db.execute(query, params)
     todos = todos.scalars().all()
     return todos
 
 
+# Read-only fast path of `get_todos`/`get_user_todos`, with the same filter,
+# order and paging: only the given columns are selected, as Core rows, no
+# ORM instance is built or tracked by the session.
+async def get_todo_rows(
+    db: AsyncSession,
+    columns: list[str],
+    user_id: str = None,
+    offset: int = 0,
+    limit: int = DEFAULT_LIMIT,
+    after: str | None = None,
+    filters: list = None,
+    sort: str | None = None,
+):
+    query = select(*[getattr(Todo, c) for c in columns])
+    query, params = Todo.build_query(filters or [], query)
+    if user_id:
+        query = query.where(Todo.owner_id == user_id)
+    query = paginate(query, Todo, after, sort=sort).limit(limit).offset(offset)
+    rs = await db.execute(query, params)
+    return rs.all()
+
+
+# Stream todos in `(created_at, id)` order, as partitions of Core rows of
+# the EXPORT_COLUMNS columns, without building ORM instances.
+# `AsyncSession.stream()` with `yield_per` uses a server side cursor where the
+# driver supports it, so only one partition of rows is in memory at a time.
+# The stream has its own read session, from a replica if any, since it
+# outlives the request handler.
+async def stream_todos(user_id: str = None, batch_size: int = EXPORT_BATCH_SIZE):
+    query = select(*[getattr(Todo, c) for c in EXPORT_COLUMNS])
+    if user_id:
+        query = query.where(Todo.owner_id == user_id)
+    query = paginate(query, Todo).execution_options(yield_per=batch_size)
+    async with ReadSessionLocal() as db:
+        rs = await db.stream(query)
+        async for rows in rs.partitions():
+            yield rows
+
+
+# Select only the `(id, updated_at)` versions of the rows of a todo page,
+# with the same filter, order and paging as `get_todos`/`get_user_todos`.
+# It is used to check whether a page changed without loading its rows.
+async def get_todos_versions(
+    db: AsyncSession,
+    user_id: str = None,
+    offset: int = 0,
+    limit: int = DEFAULT_LIMIT,
+    after: str | None = None,
+    filters: list = None,
+    sort: str | None = None,
+):
+    query, params = Todo.build_query(filters or [], select(Todo.id, Todo.updated_at))
+    if user_id:
+        query = query.where(Todo.owner_id == user_id)
+    query = paginate(query, Todo, after, sort=sort).limit(limit).offset(offset)
+    rs = await db.execute(query, params)
+    return rs.all()
+
+
 async def create_todo(db: AsyncSession, todo_data: schemas.TodoCreate):
-    # get user by owner_id
-    owner = await get_user(db, todo_data.owner_id)
-    if not owner:
+    # check owner existence by id only, loading the owner entity with its
+    # todos would also load every todo the owner already has
+    if not await user_exists(db, todo_data.owner_id):
         return None
 
     todo = Todo(
         text=todo_data.text,
         completed=todo_data.completed,
-        owner=owner,
+        owner_id=todo_data.owner_id,
     )
     db.add(todo)
     try:
@@ -54,44 +173,417 @@ async def create_todo(db: AsyncSession, todo_data: schemas.TodoCreate):
     except:
         await db.rollback()
         raise
+    await cache.invalidate(cache_key(Todo, todo.id))
     return todo
 
 
-async def update_todo(db: AsyncSession, id: str, todo_data: schemas.TodoUpdate):
-    query = select(Todo).where(Todo.id == id)
-    todos = await db.execute(query)
-    # AsyncResult.first() returns none if no row, or 1 element tuple
-    if not todos:
-        return None
-    (todo,) = todos.first()
-    todo.text = todo_data.text
-    todo.completed = todo_data.completed
-    todo.owner_id = todo_data.owner_id
-    db.add(todo)
-    try:
-        await db.commit()
-        await db.refresh(todo)
-    except:
-        await db.rollback()
-        raise
+# `todo_data` is either a full `TodoUpdate`, or a `TodoPatch` of which only
+# the fields set by the client are updated.
+# Returns None if the todo doesn't exist, raises `StaleDataError` if the
+# patch `updated_at` doesn't match, see `models_crud.update_returning`, and
+# `ValueError` if the new owner doesn't exist.
+async def update_todo(
+    db: AsyncSession, id: str, todo_data: schemas.TodoUpdate | schemas.TodoPatch
+):
+    values = todo_data.model_dump(
+        exclude_unset=True, include={"owner_id", "text", "completed"}
+    )
+    if "owner_id" in values and not await user_exists(db, values["owner_id"]):
+        raise ValueError(f"Owner not found: {values['owner_id']}")
+    expected_updated_at = getattr(todo_data, "updated_at", None)
+    if "owner_id" in values:
+        # lock the row to read the owner it is moved from, a stale patch
+        # doesn't match and moves nothing
+        query = select(Todo.id, Todo.owner_id).where(Todo.id == id)
+        if expected_updated_at is not None:
+            query = query.where(Todo.updated_at == naive_utc(expected_updated_at))
+        rs = await db.execute(query.with_for_update())
+        await add_moved_tombstones(db, rs.all(), {id: values["owner_id"]})
+    todo = await update_returning(db, Todo, id, values, expected_updated_at)
+    if todo is not None and values:
+        await cache.invalidate(cache_key(Todo, id))
     return todo
 
 
 async def delete_todo(db: Session, id: str):
-    query = sa_delete(Todo).where(Todo.id == id)
-    await db.execute(query)
+    query = sa_delete(Todo).where(Todo.id == id).returning(Todo.id, Todo.owner_id)
+    rs = await db.execute(query)
+    # record a tombstone for the changes feed in the same transaction
+    await add_tombstones(db, rs.all())
     try:
         await db.commit()
     except:
         await db.rollback()
         raise
+    await cache.invalidate(cache_key(Todo, id))
     return True
 
 
 async def get_user_todos(
-    db: AsyncSession, user_id: str, offset: int = 0, limit: int = DEFAULT_LIMIT
+    db: AsyncSession,
+    user_id: str,
+    offset: int = 0,
+    limit: int = DEFAULT_LIMIT,
+    after: str | None = None,
+    filters: list = None,
+    sort: str | None = None,
 ):
-    query = select(Todo).where(Todo.owner_id == user_id).limit(limit).offset(offset)
-    todos = await db.execute(query)
+    query, params = Todo.build_query(filters or [])
+    query = query.where(Todo.owner_id == user_id)
+    query = paginate(query, Todo, after, sort=sort).limit(limit).offset(offset)
+    todos = await db.execute(query, params)
     todos = todos.scalars().all()
     return todos
+
+
+# Todo counts by owner and completion, computed with one
+# `GROUP BY owner_id, completed` query, which the database answers from the
+# `(owner_id, completed, ...)` index without reading the todo rows.
+async def get_todo_stats(db: AsyncSession, user_ids: list[str] = None) -> dict:
+    query = select(Todo.owner_id, Todo.completed, func.count()).group_by(
+        Todo.owner_id, Todo.completed
+    )
+    if user_ids:
+        query = query.where(Todo.owner_id.in_(set(user_ids)))
+    rs = await db.execute(query)
+    stats = {"total": 0, "open": 0, "completed": 0, "owners": {}}
+    for owner_id, completed, count in rs.all():
+        owner = stats["owners"].setdefault(
+            owner_id, {"owner_id": owner_id, "total": 0, "open": 0, "completed": 0}
+        )
+        for counts in (stats, owner):
+            counts["total"] += count
+            counts["completed" if completed else "open"] += count
+    stats["owners"] = list(stats["owners"].values())
+    return stats
+
+
+# whether the database supports `search_todos`
+SEARCH_SUPPORTED = engine.dialect.name in FULLTEXT_DIALECTS
+
+
+# Full-text search of todos, ordered by `(search_rank, id)`, best matches
+# first. Returns a list of `(todo, search_rank)` rows, the rank and id of the
+# last row make the cursor of the next page, see `encode_rank_cursor`.
+async def search_todos(
+    db: AsyncSession,
+    q: str,
+    user_id: str = None,
+    limit: int = DEFAULT_LIMIT,
+    after: str | None = None,
+):
+    query = fulltext_search(Todo, q, engine.dialect.name)
+    if query is None:
+        return []
+    if user_id:
+        query = query.where(Todo.owner_id == user_id)
+    # the rank is computed per query, wrap the search in a subquery to page
+    # on its rank column
+    ranked = query.subquery()
+    todo = aliased(Todo, ranked)
+    query = select(todo, ranked.c.search_rank)
+    if after:
+        rank, id = decode_rank_cursor(after)
+        query = query.where(
+            tuple_(ranked.c.search_rank, ranked.c.id) > tuple_(rank, id)
+        )
+    query = query.order_by(ranked.c.search_rank, ranked.c.id).limit(limit)
+    rs = await db.execute(query)
+    return rs.all()
+
+
+# Bulk write operations
+#
+# Each bulk function validates all items with set based `IN` queries, then
+# writes every valid item with one executemany statement in one transaction.
+# Items failing validation are skipped and reported in the per-item results,
+# which are returned in the same order as the input items.
+
+
+async def create_todos(db: AsyncSession, todos_data: list[schemas.TodoCreate]):
+    owner_ids = await get_existing_user_ids(db, [t.owner_id for t in todos_data])
+    results = [{"index": i, "ok": False} for i in range(len(todos_data))]
+    valid = []
+    for i, t in enumerate(todos_data):
+        if t.owner_id not in owner_ids:
+            results[i]["detail"] = f"Owner not found: {t.owner_id}"
+        else:
+            valid.append(i)
+    if not valid:
+        return results
+
+    # ORM bulk insert, the list of parameter dicts is sent in batched
+    # `INSERT .. VALUES (..), (..) RETURNING ..` statements (insertmanyvalues),
+    # and `sort_by_parameter_order` keeps returned rows aligned with the input.
+    query = sa_insert(Todo).returning(Todo, sort_by_parameter_order=True)
+    try:
+        rs = await db.execute(
+            query,
+            [
+                todos_data[i].model_dump(include={"text", "completed", "owner_id"})
+                for i in valid
+            ],
+        )
+        todos = rs.scalars().all()
+        await db.commit()
+    except:
+        await db.rollback()
+        raise
+    for i, todo in zip(valid, todos):
+        results[i].update(ok=True, id=todo.id, todo=todo)
+    return results
+
+
+async def update_todos(db: AsyncSession, todos_data: list[schemas.TodoUpdate]):
+    # fetch only the columns needed to report the updated rows, loading todo
+    # entities would put stale objects in the session identity map
+    query = (
+        select(Todo.id, Todo.created_at, Todo.owner_id)
+        .where(Todo.id.in_({t.id for t in todos_data}))
+        .with_for_update()
+    )
+    rs = await db.execute(query)
+    rows = rs.all()
+    created = {row.id: row.created_at for row in rows}
+    owner_ids = await get_existing_user_ids(db, [t.owner_id for t in todos_data])
+
+    results = [{"index": i, "ok": False, "id": t.id} for i, t in enumerate(todos_data)]
+    valid = []
+    for i, t in enumerate(todos_data):
+        if t.id not in created:
+            results[i]["detail"] = f"Todo not found: {t.id}"
+        elif t.owner_id not in owner_ids:
+            results[i]["detail"] = f"Owner not found: {t.owner_id}"
+        else:
+            valid.append(i)
+    if not valid:
+        return results
+
+    # ORM bulk update by primary key, each parameter dict must carry the
+    # primary key, and all of them are sent as one executemany `UPDATE`.
+    # updated_at is set explicitly, instead of by the column `onupdate`,
+    # to report it in the results.
+    now = datetime.utcnow()
+    values = [{**todos_data[i].model_dump(), "updated_at": now} for i in valid]
+    owners = {v["id"]: v["owner_id"] for v in values}
+    try:
+        moved = [(r.id, r.owner_id) for r in rows if r.id in owners]
+        await add_moved_tombstones(db, moved, owners)
+        await db.execute(sa_update(Todo), values)
+        await db.commit()
+    except:
+        await db.rollback()
+        raise
+    await cache.invalidate(*[cache_key(Todo, v["id"]) for v in values])
+    for i, v in zip(valid, values):
+        todo = {**v, "created_at": created[v["id"]]}
+        results[i].update(ok=True, todo=todo)
+    return results
+
+
+async def delete_todos(db: AsyncSession, ids: list[str]):
+    query = (
+        sa_delete(Todo).where(Todo.id.in_(set(ids))).returning(Todo.id, Todo.owner_id)
+    )
+    try:
+        rs = await db.execute(query)
+        rows = rs.all()
+        await add_tombstones(db, rows)
+        deleted = {row.id for row in rows}
+        await db.commit()
+    except:
+        await db.rollback()
+        raise
+    await cache.invalidate(*[cache_key(Todo, id) for id in deleted])
+    results = []
+    for i, id in enumerate(ids):
+        if id in deleted:
+            results.append({"index": i, "ok": True, "id": id})
+        else:
+            results.append(
+                {"index": i, "ok": False, "id": id, "detail": f"Todo not found: {id}"}
+            )
+    return results
+
+
+# Import
+#
+# Records are validated against `schemas.TodoCreate` and inserted in chunks,
+# each chunk with one owner `IN` query for owners not seen in prior chunks,
+# one executemany `INSERT` and one commit. A chunk failing to insert is
+# rolled back and reported, the import goes on with the next chunk.
+
+
+async def import_todos(db: AsyncSession, records, chunk_size: int = IMPORT_CHUNK_SIZE):
+    report = {"received": 0, "imported": 0, "failed": 0, "chunks": 0, "errors": []}
+    known_owner_ids = set()
+
+    def fail(line: int, detail: str):
+        report["failed"] += 1
+        if len(report["errors"]) < IMPORT_MAX_ERRORS:
+            report["errors"].append({"line": line, "detail": detail})
+
+    async def import_chunk(chunk: list):
+        todos = []
+        for line, record in chunk:
+            try:
+                todos.append((line, schemas.TodoCreate.model_validate(record)))
+            except ValidationError as e:
+                fail(line, str(e))
+        unknown_owner_ids = {t.owner_id for _, t in todos} - known_owner_ids
+        known_owner_ids.update(await get_existing_user_ids(db, unknown_owner_ids))
+        values = []
+        # lines of the values, the records failed already are not inserted
+        lines = []
+        for line, t in todos:
+            if t.owner_id in known_owner_ids:
+                values.append(t.model_dump(include={"text", "completed", "owner_id"}))
+                lines.append(line)
+            else:
+                fail(line, f"Owner not found: {t.owner_id}")
+        if not values:
+            return
+        try:
+            await db.execute(sa_insert(Todo), values)
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            for line in lines:
+                fail(line, f"Chunk insert failed: {e}")
+            return
+        report["imported"] += len(values)
+        report["chunks"] += 1
+
+    chunk = []
+    async for line, record, error in records:
+        report["received"] += 1
+        if error:
+            fail(line, error)
+            continue
+        chunk.append((line, record))
+        if len(chunk) >= chunk_size:
+            await import_chunk(chunk)
+            chunk = []
+    if chunk:
+        await import_chunk(chunk)
+    return report
+
+
+# Changes feed
+#
+# Clients sync incrementally by asking for the todos changed after the last
+# change they have seen. Changes are todos ordered by `(updated_at, id)` and
+# tombstones of deleted todos ordered by `(deleted_at, id)`, merged into one
+# `(changed_at, id)` ordered feed paged with a keyset cursor.
+
+
+# Raised when a sync resumes from before the oldest tombstones kept, the
+# deletions since may have been pruned, the client must sync in full.
+class ChangesExpired(Exception):
+    pass
+
+
+# record tombstones of deleted `(id, owner_id)` rows, without committing,
+# replacing the previous tombstone of the same todo and owner
+async def add_tombstones(db: AsyncSession, rows, moved: bool = False):
+    keys = [(id, owner_id or "") for id, owner_id in rows]
+    if not keys:
+        return
+    await db.execute(
+        sa_delete(TodoTombstone).where(
+            tuple_(TodoTombstone.id, TodoTombstone.owner_id).in_(keys)
+        )
+    )
+    now = datetime.utcnow()
+    await db.execute(
+        sa_insert(TodoTombstone),
+        [
+            {"id": id, "owner_id": owner_id, "deleted_at": now, "moved": moved}
+            for id, owner_id in keys
+        ],
+    )
+
+
+# record `moved` tombstones of the current `(id, owner_id)` rows of todos
+# moved to another owner, given as a dict of id to new owner id, so that
+# the feed of the previous owner drops them
+async def add_moved_tombstones(db: AsyncSession, rows, owners: dict):
+    moved = [
+        (id, owner_id)
+        for id, owner_id in rows
+        if owner_id is not None and owner_id != owners[id]
+    ]
+    await add_tombstones(db, moved, moved=True)
+
+
+# delete the tombstones older than `tombstone_retention_seconds`, returns the
+# number of tombstones deleted
+async def prune_tombstones(db: AsyncSession) -> int:
+    horizon = datetime.utcnow() - timedelta(
+        seconds=settings.tombstone_retention_seconds
+    )
+    try:
+        rs = await db.execute(
+            sa_delete(TodoTombstone).where(TodoTombstone.deleted_at < horizon)
+        )
+        await db.commit()
+    except:
+        await db.rollback()
+        raise
+    return rs.rowcount
+
+
+# The feed only has the changes older than `changes_safety_window_seconds`:
+# a change is timestamped when its transaction writes, not when it commits,
+# so a change committed late may be older than the newest change already
+# served. Changes up to the returned `until` time are complete, provided no
+# transaction takes longer than the window.
+# Raises `ChangesExpired` when resuming from before the tombstone retention.
+# Returns the changes, and the `until` time.
+async def get_todo_changes(
+    db: AsyncSession,
+    user_id: str = None,
+    since: datetime = None,
+    after: str | None = None,
+    limit: int = DEFAULT_LIMIT,
+):
+    until = datetime.utcnow() - timedelta(
+        seconds=settings.changes_safety_window_seconds
+    )
+    horizon = datetime.utcnow() - timedelta(
+        seconds=settings.tombstone_retention_seconds
+    )
+    since = naive_utc(since)
+    position = decode_cursor(after)[0] if after else since
+    if position is not None and position < horizon:
+        raise ChangesExpired(f"Changes before {horizon.isoformat()} are expired")
+    todos = select(Todo).where(Todo.updated_at < until)
+    tombstones = select(TodoTombstone).where(TodoTombstone.deleted_at < until)
+    if user_id:
+        todos = todos.where(Todo.owner_id == user_id)
+        tombstones = tombstones.where(TodoTombstone.owner_id == user_id)
+    else:
+        # a moved todo is still there for the unfiltered feed
+        tombstones = tombstones.where(TodoTombstone.moved.is_(False))
+    if since:
+        todos = todos.where(Todo.updated_at > since)
+        tombstones = tombstones.where(TodoTombstone.deleted_at > since)
+    # both sources are read from the same cursor position, so that the first
+    # `limit` changes of their merge are the next page of the feed
+    todos = paginate(todos, Todo, after, keys=("updated_at", "id")).limit(limit)
+    tombstones = paginate(
+        tombstones, TodoTombstone, after, keys=("deleted_at", "id")
+    ).limit(limit)
+
+    rs = await db.execute(todos)
+    changes = [
+        {"id": t.id, "deleted": False, "changed_at": t.updated_at, "todo": t}
+        for t in rs.scalars().all()
+    ]
+    rs = await db.execute(tombstones)
+    changes += [
+        {"id": t.id, "deleted": True, "changed_at": t.deleted_at}
+        for t in rs.scalars().all()
+    ]
+    changes.sort(key=lambda c: (c["changed_at"], c["id"]))
+    return changes[:limit], until
@@ -1,35 +1,67 @@
-from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm import noload
 from sqlalchemy.future import select
+from sqlalchemy import func
 from sqlalchemy.ext.asyncio import AsyncSession
-from .models import User
-from .security import get_password_hash
+from .models import User, Todo
+from .security import get_password_hash_async
+from .pagination import paginate
 from . import schemas
 
 DEFAULT_LIMIT = 5
 
 
-async def get_user(db: AsyncSession, id: str):
-    # Use `joinedload` mode eager load to fetch belonging todos.
-    # Other modes are like: `selectinload`, which runs `select * where user_id in (..)`.
-    # This is a query design tradeoff of one join query vs two separate select queries.
-    query = select(User).where(User.id == id).options(joinedload(User.todos))
-    # query = select(User).where(User.id == id).options(selectinload(User.todos))
-    users = await db.execute(query)
-    user = users.first()
-    if user:
-        (user,) = user
-        return user
-    return None
+# Fetch the user without its todos, along with the total number of todos
+# the user owns, computed with a `count` scalar subquery in the same query.
+# The todos are then fetched one bounded page at a time with
+# `crud_todo.get_user_todos`, so neither the row set nor the response size
+# grows with the user's total number of todos, as it would by eager loading
+# `User.todos`.
+async def get_user_with_todos_count(db: AsyncSession, id: str):
+    todos_count = (
+        select(func.count(Todo.id)).where(Todo.owner_id == User.id).scalar_subquery()
+    )
+    query = select(User, todos_count).where(User.id == id).options(noload(User.todos))
+    rs = await db.execute(query)
+    r = rs.first()
+    if r:
+        user, count = r
+        return user, count
+    return None, 0
+
+
+# Check user existence with an id-only query, no user entity or relationship
+# is loaded, so the cost doesn't depend on how many todos the user owns.
+async def user_exists(db: AsyncSession, id: str) -> bool:
+    query = select(User.id).where(User.id == id)
+    rs = await db.execute(query)
+    return rs.scalar_one_or_none() is not None
+
+
+# Fetch the subset of given user ids that exist with a single `IN` query.
+# Only the primary key column is selected, no user entity is loaded.
+async def get_existing_user_ids(db: AsyncSession, ids) -> set[str]:
+    ids = set(ids)
+    if not ids:
+        return set()
+    query = select(User.id).where(User.id.in_(ids))
+    rs = await db.execute(query)
+    return set(rs.scalars().all())
 
 
 async def get_user_with_crudmixin(db: AsyncSession, id: str):
-    return await User.get(db, id)
+    # UserRead view doesn't include todos, raise on any relationship load
+    return await User.get(db, id, loader="raiseload", cached=True)
 
 
 async def get_users(
-    db: AsyncSession, filters: dict = {}, offset: int = 0, limit: int = DEFAULT_LIMIT
+    db: AsyncSession,
+    filters: dict = {},
+    offset: int = 0,
+    limit: int = DEFAULT_LIMIT,
+    after: str | None = None,
+    sort: str | None = None,
 ):
-    query = select(User).limit(limit).offset(offset)
+    query = paginate(select(User), User, after, sort=sort).limit(limit).offset(offset)
 
     if filters.get("email"):
         query = query.where(User.email == filters["email"])
@@ -42,27 +74,64 @@ async def get_users(
     return users
 
 
+# read-only fast path of `get_users`, see `crud_todo.get_todo_rows`
+async def get_user_rows(
+    db: AsyncSession,
+    columns: list[str],
+    offset: int = 0,
+    limit: int = DEFAULT_LIMIT,
+    after: str | None = None,
+    sort: str | None = None,
+):
+    query = select(*[getattr(User, c) for c in columns])
+    query = paginate(query, User, after, sort=sort).limit(limit).offset(offset)
+    rs = await db.execute(query)
+    return rs.all()
+
+
+# select only the `(id, updated_at)` versions of the rows of a user page,
+# see `crud_todo.get_todos_versions`
+async def get_users_versions(
+    db: AsyncSession,
+    offset: int = 0,
+    limit: int = DEFAULT_LIMIT,
+    after: str | None = None,
+    sort: str | None = None,
+):
+    query = paginate(select(User.id, User.updated_at), User, after, sort=sort)
+    rs = await db.execute(query.limit(limit).offset(offset))
+    return rs.all()
+
+
 async def filter_users(
     db: AsyncSession,
     filter_conditions: list,
     offset: int = 0,
     limit: int = DEFAULT_LIMIT,
+    sort: str | None = None,
 ):
-    query = select(User).limit(limit).offset(offset)
+    query = paginate(select(User), User, sort=sort).limit(limit).offset(offset)
     users = await User.filter(db, filter_conditions, query)
     return users
 
 
 async def get_users_with_crudmixin(
-    db: AsyncSession, offset: int = 0, limit: int = DEFAULT_LIMIT
+    db: AsyncSession,
+    offset: int = 0,
+    limit: int = DEFAULT_LIMIT,
+    after: str | None = None,
+    sort: str | None = None,
 ):
-    return await User.list(db, limit, offset)
+    return await User.list(
+        db, limit, offset, after=after, sort=sort, loader="raiseload"
+    )
 
 
 async def create_user(db: AsyncSession, user_data: schemas.UserCreate) -> User:
     user = User(
         email=user_data.email,
-        hashed_password=get_password_hash(user_data.password),
+        # hash in the worker pool, not on the event loop
+        hashed_password=await get_password_hash_async(user_data.password),
         fname=user_data.fname,
         lname=user_data.lname,
         # is_superuser=user_data.is_superuser,
@@ -1,4 +1,6 @@
-from app.db import engine
+from sqlalchemy import insert as sa_insert
+
+from app.db import write_engine
 from app.models import Base
 from app.db import SessionLocal
 from app.models import User, Todo
@@ -8,7 +10,7 @@ from app.models import User, Todo
 # use async_engine.begin() for transaction control
 # use run_sync to run a sync sqlalchemy method
 async def init_tables():
-    async with engine.begin() as conn:
+    async with write_engine.begin() as conn:
         print(">> sqlalchemy dropping existing tables")
         await conn.run_sync(Base.metadata.drop_all)
         print(">> sqlalchemy creating tables")
@@ -53,3 +55,40 @@ async def migrate_data():
             ]
         )
         await db.commit()
+
+
+# Load a synthetic dataset of `users` users with `todos_per_user` todos each,
+# e.g. for benchmarks. Rows are inserted with executemany statements in
+# chunks of `chunk_size` rows, one commit per chunk. All users share the
+# password "secret".
+async def seed_data(users: int, todos_per_user: int, chunk_size: int = 5000):
+    hashed_password = "$2b$12$mV7rTpEAAk77POssNFkBfO.F0UvhU5Z2llYTbu3RcS8s8C3S2hNUC"
+    async with SessionLocal() as db:
+        for start in range(0, users, chunk_size):
+            rs = await db.execute(
+                sa_insert(User).returning(User.id),
+                [
+                    {
+                        "email": f"user{i}@example.com",
+                        "fname": f"First{i}",
+                        "lname": f"Last{i}",
+                        "hashed_password": hashed_password,
+                    }
+                    for i in range(start, min(start + chunk_size, users))
+                ],
+            )
+            user_ids = rs.scalars().all()
+            await db.commit()
+
+            todos = [
+                {
+                    "text": f"todo {n} of user {user_id}",
+                    "completed": n % 3 == 0,
+                    "owner_id": user_id,
+                }
+                for user_id in user_ids
+                for n in range(todos_per_user)
+            ]
+            for i in range(0, len(todos), chunk_size):
+                await db.execute(sa_insert(Todo), todos[i : i + chunk_size])
+                await db.commit()
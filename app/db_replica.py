@@ -0,0 +1,166 @@
+import itertools
+import math
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+# read replica routing
+#
+# With `DB_REPLICA_URLS` set, requests with a safe method (GET, HEAD,
+# OPTIONS) get a session reading from one of the replicas, and other
+# requests a session on the primary, so a select before an update never
+# reads stale data from a replica. Within a replica session, flushes and
+# insert/update/delete statements still go to the primary.
+#
+# Each replica session picks one replica for all its reads, either:
+# - "round_robin": replicas in turn
+# - "least_busy": the replica with the fewest connections checked out
+#
+# Replicas lag behind the primary, a client reading right after writing
+# may not see its own write. After a session commits a write, reads are
+# pinned to the primary for `DB_REPLICA_STICKY_SECONDS`: commits on the
+# primary engine record the time of the last write of the request, which
+# `ReadYourWritesMiddleware` keeps in a cookie for the next requests of the
+# client, as they may be served by another worker process.
+# See: https://docs.sqlalchemy.org/en/20/orm/persistence_techniques.html#custom-vertical-partitioning
+
+LAST_WRITE_COOKIE = "db_last_write"
+
+
+class WriteState:
+    def __init__(self, last_write: float = 0):
+        self.last_write = last_write
+
+
+# time of the last write of the client of the current request
+write_state: ContextVar[WriteState] = ContextVar("write_state", default=None)
+
+
+def track_writes(primary: AsyncEngine):
+    @event.listens_for(primary.sync_engine, "commit")
+    def on_commit(conn):
+        state = write_state.get()
+        if state is not None:
+            state.last_write = time.time()
+
+
+class ReplicaSet:
+    def __init__(
+        self,
+        engines: list[AsyncEngine],
+        selection: str = "round_robin",
+        sticky_seconds: float = 2,
+    ):
+        self.engines = engines
+        self.selection = selection
+        self.sticky_seconds = sticky_seconds
+        self._turn = itertools.count()
+        # connections checked out of each replica pool, counted with pool
+        # events as not all pool classes keep a count
+        self.busy = {e: 0 for e in engines}
+        for e in engines:
+            self._count_checkouts(e)
+
+    def _count_checkouts(self, engine: AsyncEngine):
+        @event.listens_for(engine.sync_engine, "checkout")
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            self.busy[engine] += 1
+
+        @event.listens_for(engine.sync_engine, "checkin")
+        def on_checkin(dbapi_connection, connection_record):
+            self.busy[engine] -= 1
+
+    def choose(self) -> AsyncEngine:
+        # start from the next replica in turn, so that least busy ties are
+        # spread across replicas
+        start = next(self._turn) % len(self.engines)
+        engines = self.engines[start:] + self.engines[:start]
+        if self.selection == "least_busy":
+            return min(engines, key=self.busy.get)
+        return engines[0]
+
+    def sticky(self) -> bool:
+        # whether the client wrote recently enough to read from the primary
+        state = write_state.get()
+        return (
+            state is not None
+            and time.time() - state.last_write < self.sticky_seconds
+        )
+
+    async def dispose(self):
+        for e in self.engines:
+            await e.dispose()
+
+
+class ReplicaRoutingSession(Session):
+    def __init__(self, *args, primary=None, replicas: ReplicaSet = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.primary = primary
+        self.replicas = replicas
+        self.replica: AsyncEngine = None
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.wrote = True
+        if self.wrote or self.replicas.sticky():
+            return self.primary.sync_engine
+        if self.replica is None:
+            self.replica = self.replicas.choose()
+        return self.replica.sync_engine
+
+
+class ReplicaSession(AsyncSession):
+    sync_session_class = ReplicaRoutingSession
+
+
+# Pure ASGI middleware keeping the time of the last write of the client in
+# a cookie, the cookie expires with the sticky window.
+class ReadYourWritesMiddleware:
+    def __init__(self, app, sticky_seconds: float):
+        self.app = app
+        self.sticky_seconds = sticky_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        last_write = read_cookie(scope, LAST_WRITE_COOKIE)
+        state = WriteState(last_write)
+        token = write_state.set(state)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and (
+                state.last_write != last_write
+            ):
+                cookie = (
+                    f"{LAST_WRITE_COOKIE}={state.last_write:.3f}; "
+                    f"Max-Age={math.ceil(self.sticky_seconds)}; "
+                    "Path=/; HttpOnly; SameSite=Lax"
+                )
+                headers = list(message.get("headers", []))
+                headers.append((b"set-cookie", cookie.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            write_state.reset(token)
+
+
+def read_cookie(scope, name: str) -> float:
+    for key, value in scope["headers"]:
+        if key != b"cookie":
+            continue
+        for pair in value.decode("latin-1").split(";"):
+            k, _, v = pair.strip().partition("=")
+            if k == name:
+                try:
+                    return float(v)
+                except ValueError:
+                    return 0
+    return 0
@@ -0,0 +1,202 @@
+import asyncio
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.util import await_only
+
+from .config import settings
+
+# SQLite performance mode
+#
+# SQLite allows a single writer at a time. When concurrent sessions commit
+# through a connection pool, each one competes for the database lock and
+# the losers sleep in `busy_timeout` or fail with "database is locked".
+#
+# In single writer mode (`DB_SQLITE_SINGLE_WRITER=true`):
+# - reads run on a pool of read-only connections, in WAL journal mode
+#   readers never block the writer and are never blocked by it
+# - all write transactions are queued to one writer task, which owns the
+#   only write connection, so writes never compete for the database lock
+# - the writer serves queued write transactions back to back, each in its
+#   own savepoint within one shared transaction, and commits the whole
+#   batch once (group commit)
+#
+# Sessions route their statements with `get_bind`: the first flush or
+# insert/update/delete statement of a transaction leases the write
+# connection from the writer task, and from then on every statement of
+# that transaction runs on it, so the session reads its own writes.
+# See: https://docs.sqlalchemy.org/en/20/orm/persistence_techniques.html#custom-vertical-partitioning
+
+
+def set_sqlite_pragmas(engine: AsyncEngine, query_only: bool = False):
+    # pragmas are per connection settings, apply them to each new connection
+    @event.listens_for(engine.sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={settings.db_sqlite_journal_mode}")
+        cursor.execute(f"PRAGMA synchronous={settings.db_sqlite_synchronous}")
+        cursor.execute(f"PRAGMA mmap_size={settings.db_sqlite_mmap_size}")
+        cursor.execute(f"PRAGMA cache_size={settings.db_sqlite_cache_size}")
+        cursor.execute(f"PRAGMA busy_timeout={settings.db_sqlite_busy_timeout_ms}")
+        if query_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+
+def set_sqlite_explicit_begin(engine: AsyncEngine):
+    # The sqlite3 driver defers BEGIN until the first DML statement and
+    # doesn't support SAVEPOINT properly, take over transaction control and
+    # emit `BEGIN IMMEDIATE` to take the write lock upfront.
+    # See: https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl-asyncio-version
+    @event.listens_for(engine.sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def on_begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+class WriteLease:
+    def __init__(self):
+        loop = asyncio.get_running_loop()
+        # set by the writer with the write connection when it is our turn
+        self.granted = loop.create_future()
+        # set by the session with True on commit, False on rollback
+        self.released = loop.create_future()
+        # set by the writer when the batch transaction is committed
+        self.done = loop.create_future()
+
+    def release(self, commit: bool):
+        if not self.released.done():
+            self.released.set_result(commit)
+
+
+class SQLiteWriter:
+    def __init__(self, engine: AsyncEngine, max_batch: int = 100):
+        self.engine = engine
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue = None
+        self._task: asyncio.Task = None
+
+    # the writer task is started on first use, so that it runs on the event
+    # loop of the application
+    def start(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def lease(self) -> WriteLease:
+        self.start()
+        lease = WriteLease()
+        await self._queue.put(lease)
+        try:
+            await asyncio.shield(lease.granted)
+        except asyncio.CancelledError:
+            # give the connection back if it was granted in the meantime
+            lease.release(False)
+            raise
+        return lease
+
+    async def _run(self):
+        try:
+            await self._serve()
+        finally:
+            # fail queued leases, their sessions would wait forever otherwise
+            while not self._queue.empty():
+                lease = self._queue.get_nowait()
+                lease.granted.set_exception(RuntimeError("SQLite writer stopped"))
+
+    async def _serve(self):
+        async with self.engine.connect() as conn:
+            while True:
+                lease = await self._queue.get()
+                committed = []
+                try:
+                    await conn.begin()
+                    while lease is not None:
+                        lease.granted.set_result(conn.sync_connection)
+                        if await lease.released:
+                            committed.append(lease)
+                        else:
+                            lease.done.set_result(None)
+                        if len(committed) >= self.max_batch or self._queue.empty():
+                            lease = None
+                        else:
+                            lease = self._queue.get_nowait()
+                    await conn.commit()
+                except asyncio.CancelledError:
+                    await conn.rollback()
+                    for l in committed:
+                        l.done.cancel()
+                    raise
+                except Exception as e:
+                    await conn.rollback()
+                    for l in committed:
+                        l.done.set_exception(e)
+                else:
+                    for l in committed:
+                        l.done.set_result(None)
+
+
+class SQLiteRoutingSession(Session):
+    def __init__(self, *args, reader=None, writer: SQLiteWriter = None, **kwargs):
+        super().__init__(*args, join_transaction_mode="create_savepoint", **kwargs)
+        self.reader = reader
+        self.writer = writer
+        self.write_lease: WriteLease = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.write_lease is None and (
+            self._flushing or isinstance(clause, UpdateBase)
+        ):
+            # runs within the greenlet of an AsyncSession call, so the writer
+            # queue can be awaited from this sync method
+            self.write_lease = await_only(self.writer.lease())
+        if self.write_lease is not None:
+            return self.write_lease.granted.result()
+        return self.reader.sync_engine
+
+
+class SQLiteSession(AsyncSession):
+    sync_session_class = SQLiteRoutingSession
+
+    async def _release_write_lease(self, commit: bool):
+        lease = self.sync_session.write_lease
+        if lease is None:
+            return
+        self.sync_session.write_lease = None
+        lease.release(commit)
+        # wait for the batch transaction commit
+        await lease.done
+
+    async def commit(self):
+        try:
+            await super().commit()
+        except:
+            await self._release_write_lease(False)
+            raise
+        await self._release_write_lease(True)
+
+    async def rollback(self):
+        try:
+            await super().rollback()
+        finally:
+            await self._release_write_lease(False)
+
+    async def close(self):
+        try:
+            await super().close()
+        finally:
+            await self._release_write_lease(False)
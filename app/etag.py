@@ -0,0 +1,68 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response, status
+
+# conditional GET support
+#
+# Responses carry a strong `ETag` and a `Last-Modified` header derived from
+# the `(id, updated_at)` versions of the rows they contain, and requests with
+# a matching `If-None-Match` (or a recent enough `If-Modified-Since`) are
+# answered with `304 Not Modified` and no body.
+#
+# List routes first select only the versions of the page rows, so that a
+# not modified page is answered without loading and serializing its rows.
+
+
+def compute_etag(versions) -> str:
+    # versions is a sequence of tuples of row identities and update times,
+    # e.g. [(id, updated_at), ...]
+    digest = hashlib.sha1()
+    for version in versions:
+        digest.update(repr(tuple(version)).encode())
+    return f'"{digest.hexdigest()}"'
+
+
+def compute_last_modified(versions) -> datetime | None:
+    # latest update time of the versions, taken from the last tuple element
+    timestamps = [v[-1] for v in versions if v[-1] is not None]
+    return max(timestamps) if timestamps else None
+
+
+def is_conditional(request: Request) -> bool:
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime = None):
+    # If-None-Match takes precedence over If-Modified-Since, see RFC 9110
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # weak comparison: a proxy compressing the response may have made
+        # the tag weak, e.g. `W/"…"`
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or etag.removeprefix("W/") in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        # timestamps are stored as naive utc, http dates have no fraction
+        modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+        return modified <= since
+    return False
+
+
+def set_validators(response: Response, etag: str, last_modified: datetime = None):
+    response.headers["ETag"] = etag
+    if last_modified:
+        response.headers["Last-Modified"] = format_datetime(
+            last_modified.replace(tzinfo=timezone.utc), usegmt=True
+        )
+
+
+def not_modified_response(etag: str, last_modified: datetime = None) -> Response:
+    response = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+    set_validators(response, etag, last_modified)
+    return response
@@ -0,0 +1,59 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+from fastapi.responses import StreamingResponse
+
+# streaming export of query results as NDJSON or CSV
+#
+# Rows are fetched from the database in partitions (see `yield_per`) and each
+# partition is serialized to one chunk of the response body, so memory use
+# stays flat no matter how many rows are exported.
+
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+async def ndjson_chunks(partitions):
+    async for rows in partitions:
+        yield "".join(
+            json.dumps(row._asdict(), default=json_default) + "\n" for row in rows
+        )
+
+
+async def csv_chunks(partitions, columns: list[str]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    async for rows in partitions:
+        for row in rows:
+            writer.writerow(
+                v.isoformat() if isinstance(v, datetime) else v for v in row
+            )
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # header of an empty export
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_response(partitions, columns: list[str], format: str, filename: str):
+    if format == "csv":
+        chunks = csv_chunks(partitions, columns)
+    else:
+        chunks = ndjson_chunks(partitions)
+    return StreamingResponse(
+        chunks,
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{format}"'},
+    )
@@ -0,0 +1,75 @@
+import codecs
+import csv
+import json
+
+# incremental parsing of NDJSON and CSV uploads
+#
+# The request body is consumed chunk by chunk from `Request.stream()`, split
+# into lines and parsed into records as they arrive, so the whole upload is
+# never held in memory.
+# Parsers yield `(line, record, error)` tuples, with the line number where
+# the record starts, the parsed dict record, or an error message when the
+# record can't be parsed.
+
+
+async def iter_lines(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        # the last piece is an incomplete line, until the next chunk
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def ndjson_records(chunks):
+    lineno = 0
+    async for line in iter_lines(chunks):
+        lineno += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield lineno, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield lineno, None, "Invalid record: expected a JSON object"
+            continue
+        yield lineno, record, None
+
+
+async def csv_records(chunks):
+    # The first record is the header row. A quoted field may contain line
+    # breaks, a record is complete when it has an even number of quotes,
+    # as quotes within a quoted field are escaped by doubling them.
+    header = None
+    lineno = 0
+    start = 0
+    pending = []
+    async for line in iter_lines(chunks):
+        lineno += 1
+        if not pending:
+            start = lineno
+        pending.append(line)
+        if sum(l.count('"') for l in pending) % 2:
+            continue
+        text = "\n".join(pending)
+        pending = []
+        if not text.strip():
+            continue
+        row = next(csv.reader([text]))
+        if header is None:
+            header = row
+            continue
+        if len(row) != len(header):
+            yield start, None, f"Invalid CSV row: expected {len(header)} fields"
+            continue
+        yield start, dict(zip(header, row)), None
+    if pending:
+        yield start, None, "Invalid CSV row: unterminated quoted field"
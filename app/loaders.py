@@ -0,0 +1,141 @@
+import asyncio
+
+from fastapi import Depends
+from sqlalchemy import String, bindparam, func, true, union_all
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased, noload
+
+from .db import engine, get_db_session
+from .models import Todo, User
+
+# batched lookups, per request
+#
+# A `DataLoader` collects the keys loaded within one event loop iteration,
+# e.g. by `asyncio.gather` of per item lookups, and loads all of them with
+# one `IN` query on the next iteration. Each key is loaded once per loader:
+# lookups of a key already loaded or being loaded share its future.
+#
+# Loaders hold the instances they loaded, so they live as long as the request
+# session they query, see `get_loaders`.
+# See: https://github.com/graphql/dataloader
+
+# max number of owners per `UNION ALL` query of `todos_by_owner`, SQLite
+# limits a compound select to 500 selects
+UNION_MAX_SELECTS = 500
+
+
+class DataLoader:
+    def __init__(self, batch_load, default=None):
+        """
+        :param batch_load: async function of a list of keys, returning a dict
+            of the found keys to their values
+        :param default: value of the keys not found
+        """
+        self.batch_load = batch_load
+        self.default = default
+        self.futures = {}
+        self.pending = []
+
+    def load(self, key) -> asyncio.Future:
+        future = self.futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.futures[key] = loop.create_future()
+            if not self.pending:
+                loop.call_soon(self._dispatch)
+            self.pending.append(key)
+        return future
+
+    def load_many(self, keys) -> asyncio.Future:
+        # the keys are queued right away, not when the result is awaited
+        return asyncio.gather(*[self.load(k) for k in keys])
+
+    def _dispatch(self):
+        keys, self.pending = self.pending, []
+        asyncio.create_task(self._load(keys))
+
+    async def _load(self, keys: list):
+        try:
+            values = await self.batch_load(keys)
+        except Exception as e:
+            for k in keys:
+                self.futures.pop(k).set_exception(e)
+            return
+        for k in keys:
+            self.futures[k].set_result(values.get(k, self.default))
+
+
+class Loaders:
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        # an AsyncSession runs one statement at a time, loaders of different
+        # models may dispatch in the same iteration
+        self.lock = asyncio.Lock()
+        self.users = DataLoader(self._load_users)
+        self._todos_by_owner = {}
+
+    def todos_by_owner(self, limit: int) -> DataLoader:
+        # todos of each owner in `(created_at, id)` order, up to limit per owner
+        if limit not in self._todos_by_owner:
+
+            async def load(owner_ids):
+                return await self._load_todos_by_owner(owner_ids, limit)
+
+            self._todos_by_owner[limit] = DataLoader(load, default=[])
+        return self._todos_by_owner[limit]
+
+    async def _load_users(self, ids: list) -> dict:
+        query = select(User).where(User.id.in_(ids)).options(noload(User.todos))
+        async with self.lock:
+            rs = await self.db.execute(query)
+        return {u.id: u for u in rs.scalars()}
+
+    async def _load_todos_by_owner(self, owner_ids: list, limit: int) -> dict:
+        # the first `limit` todos of each owner, each read with a range scan
+        # of the `(owner_id, created_at, id)` index that stops after `limit`
+        # rows, however many todos an owner has
+        todos = {}
+        for i in range(0, len(owner_ids), UNION_MAX_SELECTS):
+            chunk = owner_ids[i : i + UNION_MAX_SELECTS]
+            for t in await self._load_first_todos(chunk, limit):
+                todos.setdefault(t.owner_id, []).append(t)
+        return todos
+
+    async def _load_first_todos(self, owner_ids: list, limit: int) -> list:
+        def first_todos(owner_id):
+            return (
+                select(Todo)
+                .where(Todo.owner_id == owner_id)
+                .order_by(Todo.created_at, Todo.id)
+                .limit(limit)
+            )
+
+        if engine.dialect.name == "postgresql":
+            # a LATERAL subquery runs once per owner id of the array
+            owners = (
+                func.unnest(bindparam("owner_ids", owner_ids, type_=ARRAY(String)))
+                .table_valued("owner_id")
+                .render_derived(name="owners")
+            )
+            todos = first_todos(owners.c.owner_id).lateral()
+            query = select(todos).select_from(owners.join(todos, true()))
+        else:
+            # a UNION ALL of one limited select per owner
+            query = union_all(*[select(first_todos(id).subquery()) for id in owner_ids])
+        todos = query.subquery()
+        todo = aliased(Todo, todos)
+        query = (
+            select(todo)
+            .order_by(todos.c.owner_id, todos.c.created_at, todos.c.id)
+            .options(noload(todo.owner))
+        )
+        async with self.lock:
+            rs = await self.db.execute(query)
+        return rs.scalars().all()
+
+
+# FastAPI dependency of the request loaders, on the request session
+async def get_loaders(db: AsyncSession = Depends(get_db_session)) -> Loaders:
+    return Loaders(db)
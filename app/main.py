@@ -1,9 +1,20 @@
+import asyncio
+import logging
 import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from .routers import users, todos
+from . import crud_todo
 from .db_migration import init_tables, migrate_data
+from .config import settings
+from .db import SessionLocal, dispose_engines, engine, replicas
+from .db_replica import ReadYourWritesMiddleware
+from .security import hash_pool_stats, shutdown_hash_executor
+from .query_stats import QueryStatsMiddleware
+from .cache import cache
+from .metrics import CallbackGauge, MetricsMiddleware, metrics_response, registry
 
+logger = logging.getLogger(__name__)
 
 app = FastAPI(
     dependencies=[],
@@ -25,6 +36,60 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# per request query count and db time in `Server-Timing` headers, N+1 query
+# detection and query budget, see `query_stats.py`
+app.add_middleware(QueryStatsMiddleware)
+# request latency and in flight requests, for `GET /metrics`
+app.add_middleware(MetricsMiddleware)
+# keep reads on the primary right after a client writes, see `db_replica.py`
+if replicas is not None:
+    app.add_middleware(
+        ReadYourWritesMiddleware, sticky_seconds=replicas.sticky_seconds
+    )
+
+
+# Connection pool state, read at scrape time. Only queue pools keep a count
+# of connections, the pool is read from the engine each time since disposing
+# the engine replaces it.
+def pool_stat(name: str):
+    def read():
+        engines = [engine] + (replicas.engines if replicas is not None else [])
+        pools = [e.sync_engine.pool for e in engines]
+        return {
+            (p.logging_name,): getattr(p, name)() for p in pools if hasattr(p, name)
+        }
+
+    return read
+
+
+for name, help in [
+    ("size", "Pool size"),
+    ("checkedout", "Connections checked out of the pool"),
+    ("overflow", "Connections open over the pool size, negative when below"),
+]:
+    registry.register(
+        CallbackGauge(f"db_pool_{name}", help, pool_stat(name), labels=("engine",))
+    )
+for name, help in [
+    ("queued", "Password hashes waiting for a free slot"),
+    ("running", "Password hashes running in the hash pool"),
+    ("completed", "Password hashes completed"),
+    ("wait_seconds", "Total seconds password hashes waited in queue"),
+]:
+    registry.register(
+        CallbackGauge(
+            f"password_hash_{name}", help, lambda name=name: hash_pool_stats[name]
+        )
+    )
+registry.register(
+    CallbackGauge(
+        "cache_requests",
+        "Read-through cache lookups",
+        lambda: {(k,): v for k, v in cache.stats().items()},
+        labels=("result",),
+    )
+)
+
 
 @app.get("/")
 def read_root():
@@ -36,20 +101,47 @@ async def read_root_async():
     return {"message": "fastapi async!"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    return metrics_response()
+
+
 app.include_router(users.router)
 app.include_router(todos.router)
 
 
+# delete the expired tombstones of the changes feed periodically
+async def prune_tombstones():
+    while True:
+        await asyncio.sleep(settings.tombstone_prune_interval_seconds)
+        try:
+            async with SessionLocal() as db:
+                pruned = await crud_todo.prune_tombstones(db)
+            logger.info("pruned %d expired tombstones", pruned)
+        except Exception:
+            logger.exception("tombstone pruning failed")
+
+
+prune_task: asyncio.Task = None
+
+
 @app.on_event("startup")
 async def on_startup():
+    global prune_task
     # perform database initialization and data load
     if os.environ.get("RESET_DB"):
         print(">> initializing tables")
         await init_tables()
         print(">> loading initial data")
         await migrate_data()
+    prune_task = asyncio.create_task(prune_tombstones())
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
     print(">> app shutting down")
+    if prune_task is not None:
+        prune_task.cancel()
+    # stop the sqlite writer and close pooled connections
+    await dispose_engines()
+    shutdown_hash_executor()
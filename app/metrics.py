@@ -0,0 +1,205 @@
+import time
+from bisect import bisect_left
+
+from fastapi import Response
+
+# prometheus style metrics
+#
+# Metrics are exposed at `GET /metrics` in the prometheus text format.
+# See: https://prometheus.io/docs/instrumenting/exposition_formats/
+#
+# Metric updates are plain attribute and dict updates, with no locks: they
+# happen on the event loop thread only, so they never race, and cost about
+# as much as a dict lookup. Values derived from other components, such as
+# the connection pool or the bcrypt pool, are read when metrics are scraped
+# by gauges with a callback, and cost nothing per request.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def samples(self):
+        # yield (name suffix, label names, label values, value)
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(names, values)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, *labels, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield "", self.labels, labels, value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels, value: float = 1):
+        self.inc(*labels, value=-value)
+
+
+# A gauge read from a callback at scrape time, the callback returns a value,
+# or a dict of label values tuples to values.
+class CallbackGauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, callback, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.callback = callback
+
+    def samples(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield "", self.labels, labels, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: tuple = (), buckets=DEFAULT_BUCKETS
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # per label values: [bucket counts..., +Inf count], sum
+        self.values = {}
+
+    def observe(self, value: float, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        # count in the first bucket the value fits in, buckets are made
+        # cumulative when rendered
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        names = self.labels + ("le",)
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield "_bucket", names, labels + (bound,), cumulative
+            yield "_sum", self.labels, labels, total
+            yield "_count", self.labels, labels, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self.metrics) + "\n"
+
+
+registry = Registry()
+
+http_requests_in_flight = registry.register(
+    Gauge("http_requests_in_flight", "Requests being served")
+)
+http_request_duration_seconds = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Request latency by route template",
+        labels=("method", "route", "status"),
+    )
+)
+db_pool_wait_seconds = registry.register(
+    Histogram(
+        "db_pool_wait_seconds",
+        "Time to check out a connection from the pool",
+        labels=("engine",),
+    )
+)
+db_transactions_total = registry.register(
+    Counter(
+        "db_transactions_total",
+        "Session commits and rollbacks",
+        labels=("outcome",),
+    )
+)
+singleflight_requests_total = registry.register(
+    Counter(
+        "singleflight_requests_total",
+        "Coalesced read calls by outcome",
+        labels=("flight", "outcome"),
+    )
+)
+singleflight_fan_in = registry.register(
+    Histogram(
+        "singleflight_fan_in",
+        "Callers sharing each coalesced read",
+        labels=("flight",),
+        buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+    )
+)
+
+
+def metrics_response() -> Response:
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+# Pure ASGI middleware measuring request latency, labeled by route template
+# (e.g. `/api/todos/{id}`) rather than by path, to bound the number of series.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_flight.dec()
+            # the router sets the matched route in the scope
+            route = scope.get("route")
+            http_request_duration_seconds.observe(
+                time.perf_counter() - started,
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                status,
+            )
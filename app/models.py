@@ -1,11 +1,13 @@
 import uuid
-from sqlalchemy import Boolean, Column, ForeignKey, String, DateTime
+from datetime import datetime
+from sqlalchemy import Boolean, Column, ForeignKey, String, DateTime, Index, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
 from .models_timestamp import AutoTimestampMixin
 from .models_crud import CrudMixin
 from .models_filter import FilterMixin
+from .models_search import add_fulltext_index
 
 Base = declarative_base()
 
@@ -13,9 +15,37 @@ Base = declarative_base()
 # NOTE: to work with sqlite3, as sqlite3 doesn't have a built-in UUID type, we
 # use a string type for the uuid column.
 
+# NOTE: list queries are ordered by `(created_at, id)` for keyset pagination,
+# see `pagination.py`. The composite indexes declared in `__table_args__` let
+# the database serve each page with an index range scan instead of a sort.
+# `__sortable__` whitelists the columns of the `sort` parameter, each sort
+# key has an index ending with `id` to serve it, alone or after an equality
+# filter, in both directions. It maps each key to the columns following it
+# in its index, which the order continues with before `id`, so that the
+# index serves the whole order.
+
 
 class User(Base, AutoTimestampMixin, CrudMixin, FilterMixin):
     __tablename__ = "users"
+    __table_args__ = (
+        Index("ix_users_created_at_id", "created_at", "id"),
+        Index("ix_users_updated_at_id", "updated_at", "id"),
+        Index("ix_users_email_id", "email", "id"),
+        Index("ix_users_lname_fname_id", "lname", "fname", "id"),
+    )
+    __sortable__ = {
+        "created_at": (),
+        "updated_at": (),
+        "email": (),
+        "lname": ("fname",),
+    }
+    # never copied to the read-through cache, see `cache.to_cache`
+    __cache_exclude__ = {"hashed_password"}
+    __filterable__ = {
+        "email": {"eq", "in", "like", "ilike"},
+        "lname": {"eq", "like", "ilike"},
+        "fname": {"eq", "like", "ilike"},
+    }
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()), index=True)
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String, nullable=False)
@@ -24,10 +54,71 @@ class User(Base, AutoTimestampMixin, CrudMixin, FilterMixin):
     todos = relationship("Todo", back_populates="owner", cascade="all, delete-orphan")
 
 
-class Todo(Base, AutoTimestampMixin):
+class Todo(Base, AutoTimestampMixin, FilterMixin):
     __tablename__ = "todos"
+    __table_args__ = (
+        Index("ix_todos_created_at_id", "created_at", "id"),
+        # serves per-owner pages of `get_user_todos`
+        Index("ix_todos_owner_id_created_at_id", "owner_id", "created_at", "id"),
+        # serve the `(updated_at, id)` ordered changes feed
+        Index("ix_todos_updated_at_id", "updated_at", "id"),
+        Index("ix_todos_owner_id_updated_at_id", "owner_id", "updated_at", "id"),
+        # serve `completed` filters and sorts, alone or per owner
+        Index("ix_todos_completed_created_at_id", "completed", "created_at", "id"),
+        Index(
+            "ix_todos_owner_id_completed_created_at_id",
+            "owner_id",
+            "completed",
+            "created_at",
+            "id",
+        ),
+        # serves `sort=completed,-created_at`, open todos newest first
+        Index(
+            "ix_todos_completed_created_at_desc_id",
+            "completed",
+            text("created_at DESC"),
+            text("id DESC"),
+        ),
+    )
+    __sortable__ = {
+        "created_at": (),
+        "updated_at": (),
+        "completed": ("created_at",),
+        "owner_id": ("created_at",),
+    }
+    __filterable__ = {
+        "completed": {"eq", "ne"},
+        "owner_id": {"eq", "in"},
+        "created_at": {"eq", "lt", "le", "gt", "ge"},
+    }
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()), index=True)
-    text = Column(String, index=True)
+    # text is searched with a full-text index, see `add_fulltext_index` below
+    text = Column(String)
     completed = Column(Boolean, default=False)
     owner_id = Column(String, ForeignKey("users.id"))
     owner = relationship("User", back_populates="todos")
+
+
+add_fulltext_index(Todo.__table__, "text")
+
+
+# A tombstone records the deletion of a todo, so that the changes feed can
+# tell clients which todos to delete. It is written in the same transaction
+# as the todo deletion. A todo moved to another owner leaves a `moved`
+# tombstone for its previous owner, only served by the feed of that owner.
+# There is one tombstone per todo and owner, ownerless todos are recorded
+# with an empty `owner_id`. Tombstones are pruned after
+# `TOMBSTONE_RETENTION_SECONDS`.
+class TodoTombstone(Base):
+    __tablename__ = "todo_tombstones"
+    __table_args__ = (
+        Index("ix_todo_tombstones_deleted_at_id", "deleted_at", "id"),
+        Index(
+            "ix_todo_tombstones_owner_id_deleted_at_id", "owner_id", "deleted_at", "id"
+        ),
+    )
+    # id of the deleted todo
+    id = Column(String, primary_key=True)
+    owner_id = Column(String, primary_key=True, default="")
+    deleted_at = Column(DateTime, nullable=False, default=lambda: datetime.utcnow())
+    moved = Column(Boolean, nullable=False, default=False)
@@ -2,6 +2,12 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy import update as sa_update
 from sqlalchemy import delete as sa_delete
+from sqlalchemy.orm import joinedload, lazyload, noload, raiseload, selectinload
+from sqlalchemy.orm.exc import StaleDataError
+
+from .pagination import paginate
+from .cache import cache, cache_key, from_cache, to_cache
+from .models_timestamp import naive_utc
 
 
 # Class level CRUD functions provide common support of CRUD operations
@@ -12,26 +18,150 @@ from sqlalchemy import delete as sa_delete
 # is needed to fetch the instance from the session.
 
 
+# Relationship loader strategies that can be chosen per call by name.
+# See: https://docs.sqlalchemy.org/en/20/orm/queryguide/relationships.html#wildcard-loading-strategies
+LOADER_STRATEGIES = {
+    "joinedload": joinedload,
+    "selectinload": selectinload,
+    "lazyload": lazyload,
+    "noload": noload,
+    "raiseload": raiseload,
+}
+
+
+# Update a row by primary key in one `UPDATE .. RETURNING` round trip, the
+# returned row is loaded as the model instance, with the `updated_at` set by
+# the column `onupdate`. Dialects without `UPDATE .. RETURNING` (e.g. MySQL)
+# select the row after the update instead.
+#
+# Optimistic concurrency: with `expected_updated_at`, the update only applies
+# if the row wasn't updated since the client read it, and `StaleDataError`
+# is raised otherwise. The check is part of the `UPDATE` where clause, so no
+# concurrent update can slip in between a check and the update.
+async def update_returning(
+    db: AsyncSession, model, id, values: dict, expected_updated_at=None
+):
+    """
+    :param values: column values to set, an empty dict updates nothing and
+        returns the row as is
+    :param expected_updated_at: `updated_at` of the row as last read
+    :return: the updated instance, or None if there's no row with this id
+    """
+    where = [model.id == id]
+    if expected_updated_at is not None:
+        expected_updated_at = naive_utc(expected_updated_at)
+        where.append(model.updated_at == expected_updated_at)
+
+    if not values:
+        rs = await db.execute(select(model).where(*where))
+        obj = rs.scalar_one_or_none()
+    else:
+        query = sa_update(model).where(*where).values(**values)
+        try:
+            if db.get_bind().dialect.update_returning:
+                rs = await db.execute(query.returning(model))
+                obj = rs.scalar_one_or_none()
+            else:
+                rs = await db.execute(query)
+                obj = None
+                if rs.rowcount:
+                    rs = await db.execute(
+                        select(model)
+                        .where(model.id == id)
+                        .execution_options(populate_existing=True)
+                    )
+                    obj = rs.scalar_one()
+            await db.commit()
+        except:
+            await db.rollback()
+            raise
+
+    # tell a missing row from a stale one, only when nothing was updated
+    if obj is None and expected_updated_at is not None:
+        rs = await db.execute(select(model.id).where(model.id == id))
+        if rs.first():
+            raise StaleDataError(
+                f"{model.__name__} {id} was updated since {expected_updated_at}"
+            )
+    return obj
+
+
 class CrudMixin:
 
     # There is a big limitation of a class level list or get function:
     # the query can not be built with model specific ORM relationship.
     # Therefore, the query won't be able to support a custom eager fetch,
     # such as `select(..).where(..).options(joinedload(User.todos))`.
+    # To work around it, `list` and `get` take per call loader settings:
+    # - `loader`: name of a strategy in LOADER_STRATEGIES, applied to all
+    #   relationships of the model with a `*` wildcard,
+    #   e.g. `loader="raiseload"` to make sure nothing is lazy loaded
+    # - `options`: explicit loader options built by the caller,
+    #   e.g. `options=[selectinload(User.todos)]`
 
     @classmethod
-    async def list(cls, db: AsyncSession, limit: int = 10, offset: int = 0):
+    def _loader_options(cls, loader: str = None, options: list = None) -> list:
+        opts = []
+        if loader:
+            if loader not in LOADER_STRATEGIES:
+                raise ValueError(f"Invalid loader strategy: {loader}")
+            opts.append(LOADER_STRATEGIES[loader]("*"))
+        if options:
+            opts.extend(options)
+        return opts
 
-        query = select(cls).limit(limit).offset(offset)
+    # The list is ordered by `(created_at, id)`, or by the `sort` keys
+    # whitelisted in the model `__sortable__`, so that pages are stable
+    # between calls, and an `after` cursor switches to keyset pagination.
+    # See `pagination.py`.
+    @classmethod
+    async def list(
+        cls,
+        db: AsyncSession,
+        limit: int = 10,
+        offset: int = 0,
+        after: str = None,
+        loader: str = None,
+        options: list = None,
+        sort: str = None,
+    ):
+
+        query = paginate(select(cls), cls, after, sort=sort)
+        query = query.limit(limit).offset(offset)
+        query = query.options(*cls._loader_options(loader, options))
         users = await db.execute(query)
         # By sqlalchemy doc: use `.scalars()` method to skip the generation of
         # `Row` objects and instead receive ORM entities directly.
         # See: https://docs.sqlalchemy.org/en/20/orm/queryguide/select.html#selecting-orm-entities-and-attributes
         return users.scalars().all()
 
+    # With `cached`, `get` is read-through cached, see `cache.py`, for reads
+    # only: a hit is a detached instance, changes to it are not persisted.
+    # The cached instance holds column values only, so the cache is bypassed
+    # when relationships are to be loaded by `loader` or `options`.
     @classmethod
-    async def get(cls, db: AsyncSession, id):
+    async def get(
+        cls,
+        db: AsyncSession,
+        id,
+        loader: str = None,
+        options: list = None,
+        cached: bool = False,
+    ):
+        if not cached or options or loader not in (None, "noload", "raiseload"):
+            return await cls._get(db, id, loader, options)
+
+        async def load():
+            d = await cls._get(db, id, loader, options)
+            return to_cache(d) if d else None
+
+        data = await cache.get_or_load(cache_key(cls, id), load)
+        return from_cache(cls, data) if data else None
+
+    @classmethod
+    async def _get(cls, db: AsyncSession, id, loader: str = None, options: list = None):
         query = select(cls).where(cls.id == id)
+        query = query.options(*cls._loader_options(loader, options))
         rs = await db.execute(query)
         # AsyncResult.first() returns none if no row, or 1-element tuple
         r = rs.first()
@@ -45,28 +175,20 @@ class CrudMixin:
         db.add(cls(**kwargs))
         await db.commit()
 
-    # About synchronization strategy in ORM update:
-    # `synchronize_session` chooses the strategy to update the attributes on
-    # objects in the session.
-    # In this case `fetch` indicates the list of affected primary keys should
-    # be fetched either via a separate select statement or via `returning` if
-    # the backend database supports it.
-    # Objects locally present in memory will be updated in memory based on
-    # these primary key identities. — from SQLAlchemy Documentation
-    # See: https://docs.sqlalchemy.org/en/20/orm/queryguide/dml.html#selecting-a-synchronization-strategy
+    # The update returns the updated row, there's no need for a `fetch`
+    # synchronization strategy selecting the affected primary keys: objects
+    # of the session are refreshed with the returned row.
+    # See `update_returning` for the optimistic concurrency check.
     @classmethod
-    async def update(cls, db: AsyncSession, id, **kwargs):
-        query = (
-            sa_update(cls)
-            .where(cls.id == id)
-            .values(**kwargs)
-            .execution_options(synchronize_session="fetch")
-        )
-        await db.execute(query)
-        await db.commit()
+    async def update(cls, db: AsyncSession, id, expected_updated_at=None, **kwargs):
+        obj = await update_returning(db, cls, id, kwargs, expected_updated_at)
+        if obj is not None:
+            await cache.invalidate(cache_key(cls, id))
+        return obj
 
     @classmethod
     async def delete(cls, db: AsyncSession, id):
         query = sa_delete(cls).where(cls.id == id)
         await db.execute(query)
         await db.commit()
+        await cache.invalidate(cache_key(cls, id))
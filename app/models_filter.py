@@ -1,77 +1,137 @@
+import logging
+from functools import lru_cache
+
+from sqlalchemy import bindparam
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
+logger = logging.getLogger(__name__)
+
 # general support of dynamic filters in ORM query
+#
+# Filter conditions are `(key, operator, value)` tuples. The shape of a list
+# of conditions, its `(key, operator)` pairs, is compiled once to a filter
+# plan: a list of column expressions with named bound parameters in place of
+# the values, cached per model and shape. The values are passed as execution
+# parameters, so the same statement is built for every request of the same
+# shape and SQLAlchemy's compiled statement cache is reused, `in` conditions
+# use an expanding parameter so that list sizes don't matter either.
+# See: https://docs.sqlalchemy.org/en/20/core/connections.html#sql-compilation-caching
+
+# column expression of each filter operator, given a column and a bound
+# parameter
+FILTER_OPERATORS = {
+    "eq": lambda c, p: c == p,
+    "ne": lambda c, p: c != p,
+    "lt": lambda c, p: c < p,
+    "le": lambda c, p: c <= p,
+    "gt": lambda c, p: c > p,
+    "ge": lambda c, p: c >= p,
+    "in": lambda c, p: c.in_(p),
+    "like": lambda c, p: c.like(p),
+    "ilike": lambda c, p: c.ilike(p),
+}
+
+# operators a B-tree index can serve, `like` only with a constant prefix
+INDEXABLE_OPERATORS = {"eq", "ne", "lt", "le", "gt", "ge", "in", "like"}
 
 
 class FilterMixin:
+    # Whitelist of filterable columns and their allowed operators, e.g.
+    # `{"email": {"eq", "ilike"}}`. Conditions on other columns or with
+    # other operators are rejected.
+    __filterable__: dict = {}
+
     @classmethod
     def build_query(cls, filter_conditions: list, query=None):
         """
-        Return filtered queryset based on filter condition.
+        Return filtered queryset based on filter condition, and the parameters
+        to execute it with.
         :param query: pre-defined base query object
         :param filter_conditions: a list of filters, ie: [(key, operator, value)]
         operator list:
             eq for ==
-            lt for <
-            ge for >=
+            ne for !=
+            lt, le, gt, ge for <, <=, >, >=
             in for in_
             like for like
             ilike for ilike
-            value could be list or a CSV string
-        :return: queryset
+            value could be list or a CSV string for in, "null" for None
+        :return: (queryset, parameters)
         """
 
         if query is None:
             query = select(cls)
 
-        for fc in filter_conditions:
+        shape = []
+        params = {}
+        for i, fc in enumerate(filter_conditions):
             try:
                 key, op, value = fc
             except ValueError:
-                raise Exception(f"Invalid filter: {fc}")
-            # get model column by key
-            column = getattr(cls, key, None)
-            if not column:
-                raise Exception(f"Invalid filter column: {key}")
+                raise ValueError(f"Invalid filter: {fc}")
+            if op == "in" and not isinstance(value, (list, tuple, set)):
+                value = value.split(",")
+            if value == "null":
+                value = None
+            # comparisons with null are `is`/`is not`, not a bound parameter
+            null = value is None and op in ("eq", "ne")
+            shape.append((key, op, null))
+            if not null:
+                params[f"{key}_{op}_{i}"] = value
+
+        criteria = cls._filter_plan(tuple(shape))
+        if criteria:
+            query = query.where(*criteria)
+        return query, params
 
-            # build filter with column expression
-            # see: https://docs.sqlalchemy.org/en/20/core/sqlelement.html#sqlalchemy.sql.expression.ColumnElement
-            # translate op `in` to `ColumnElement.in_()`
-            if op == "in":
-                if isinstance(value, list):
-                    fltr = column.in_(value)
-                else:
-                    fltr = column.in_(value.split(","))
+    @classmethod
+    @lru_cache(maxsize=256)
+    def _filter_plan(cls, shape: tuple) -> tuple:
+        # compile a filter shape, a tuple of `(key, op, null)`, to column
+        # expressions with bound parameters named as in `build_query`
+        criteria = []
+        for i, (key, op, null) in enumerate(shape):
+            allowed = cls.__filterable__.get(key)
+            if allowed is None:
+                raise ValueError(f"Invalid filter column: {key}")
+            if op not in allowed or op not in FILTER_OPERATORS:
+                raise ValueError(f"Invalid filter operator: {op}")
+            column = getattr(cls, key)
+            if null:
+                fltr = column.is_(None) if op == "eq" else column.is_not(None)
             else:
-                # translate op `op` to one of the following possible forms:
-                # - `op()`
-                # - `op_()`
-                # - `__op__()`
-                # and use `hasattr` to find the one that is supported by the
-                # target ColumnElement
-                try:
-                    supported_op_form = list(
-                        filter(
-                            lambda expr: hasattr(column, expr % op),
-                            ["%s", "%s_", "__%s__"],
-                        )
-                    )[0]
-                    # get op string with found supported form
-                    op_attr = supported_op_form % op
-                except IndexError:  # supported op not found for this column
-                    raise Exception(f"Invalid filter operator: {op}")
-                if value == "null":
-                    value = None
-                # construct column expression function
-                fltr = getattr(column, op_attr)(value)
+                param = bindparam(f"{key}_{op}_{i}", expanding=op == "in")
+                fltr = FILTER_OPERATORS[op](column, param)
+            criteria.append(fltr)
+            cls._check_index(key, op)
+        return tuple(criteria)
 
-            # concatenate filter from each filter condition to existing query
-            query = query.filter(fltr)
-        return query
+    @classmethod
+    def _check_index(cls, key: str, op: str):
+        # Warn, once per filter shape, about conditions that no index can
+        # serve: an index is only usable when it leads with the column.
+        if op not in INDEXABLE_OPERATORS:
+            logger.warning(
+                "Filter %s.%s %s can't use an index, it scans the table",
+                cls.__tablename__,
+                key,
+                op,
+            )
+            return
+        column = cls.__table__.c[key]
+        leading = {list(index.columns)[0].name for index in cls.__table__.indexes}
+        if not (column.primary_key or column.unique or key in leading):
+            logger.warning(
+                "Filter %s.%s %s has no index leading with %s",
+                cls.__tablename__,
+                key,
+                op,
+                key,
+            )
 
     @classmethod
     async def filter(cls, db: AsyncSession, filter_conditions: list, query=None):
-        qry = cls.build_query(filter_conditions, query)
-        rs = await db.execute(qry)
+        qry, params = cls.build_query(filter_conditions, query)
+        rs = await db.execute(qry, params)
         return rs.scalars().all()
@@ -0,0 +1,125 @@
+import re
+
+from sqlalchemy import DDL, Float, cast, event, func, literal, literal_column
+from sqlalchemy import column as sa_column, table as sa_table
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.future import select
+
+# full-text search support for models
+#
+# A B-tree index on a text column only serves equality and prefix `LIKE`
+# lookups, a search for words within the text is a full table scan.
+# `add_fulltext_index` sets up an inverted index of the words of a column
+# when its table is created, depending on the dialect:
+# - sqlite: an FTS5 virtual table using the model table as external content,
+#   so the text is not stored twice, kept in sync by insert, update and
+#   delete triggers
+# - postgresql: a generated `tsvector` column with a GIN index
+#
+# The FTS5 table is keyed by the model table `rowid`, which `VACUUM` may
+# renumber for tables without an integer primary key. After a `VACUUM`,
+# rebuild the index with `INSERT INTO <table>_fts(<table>_fts) VALUES('rebuild')`.
+# See: https://www.sqlite.org/fts5.html#external_content_tables
+# See: https://www.postgresql.org/docs/current/textsearch-tables.html
+
+
+def add_fulltext_index(table, column: str, config: str = "english"):
+    """
+    Register the DDL creating the full-text index of a column with its table.
+    :param table: Table of the model
+    :param column: name of the text column to index
+    :param config: postgresql text search configuration
+    """
+    fts = f"{table.name}_fts"
+    vector = f"{column}_search"
+    table.info["fulltext"] = {"column": column, "config": config}
+
+    sqlite_ddl = [
+        # the porter tokenizer matches word stems, as the postgresql
+        # `english` configuration does
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+        f"{column}, content='{table.name}', content_rowid='rowid', "
+        f"tokenize='porter unicode61')",
+        f"CREATE TRIGGER {fts}_ai AFTER INSERT ON {table.name} BEGIN "
+        f"INSERT INTO {fts}(rowid, {column}) VALUES (new.rowid, new.{column}); "
+        f"END",
+        f"CREATE TRIGGER {fts}_ad AFTER DELETE ON {table.name} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {column}) "
+        f"VALUES ('delete', old.rowid, old.{column}); "
+        f"END",
+        f"CREATE TRIGGER {fts}_au AFTER UPDATE OF {column} ON {table.name} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {column}) "
+        f"VALUES ('delete', old.rowid, old.{column}); "
+        f"INSERT INTO {fts}(rowid, {column}) VALUES (new.rowid, new.{column}); "
+        f"END",
+    ]
+    postgresql_ddl = [
+        f"ALTER TABLE {table.name} ADD COLUMN {vector} tsvector "
+        f"GENERATED ALWAYS AS (to_tsvector('{config}', coalesce({column}, ''))) "
+        f"STORED",
+        f"CREATE INDEX ix_{table.name}_{vector} ON {table.name} USING gin ({vector})",
+    ]
+    for statement in sqlite_ddl:
+        event.listen(table, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+    for statement in postgresql_ddl:
+        event.listen(
+            table, "after_create", DDL(statement).execute_if(dialect="postgresql")
+        )
+    # the triggers are dropped with the table, the virtual table is not
+    event.listen(
+        table,
+        "before_drop",
+        DDL(f"DROP TABLE IF EXISTS {fts}").execute_if(dialect="sqlite"),
+    )
+
+
+def search_terms(q: str) -> list[str]:
+    # Only words are kept, so that user input never reaches the FTS5 or
+    # tsquery syntax as operators.
+    return re.findall(r"\w+", q)
+
+
+# dialects with a full-text index, see `add_fulltext_index`
+FULLTEXT_DIALECTS = ("postgresql", "sqlite")
+
+
+def fulltext_search(model, q: str, dialect: str):
+    """
+    Return a select query of model rows matching all words of q, as word
+    prefixes, with their `search_rank`, lower ranks are better matches.
+    The query is not ordered, it returns None when q has no words.
+    :param model: orm model class with a full-text indexed table
+    :param q: user search text
+    :param dialect: name of the database dialect
+    :return: query
+    """
+    terms = search_terms(q)
+    if not terms:
+        return None
+    table = model.__table__
+    info = table.info["fulltext"]
+    if dialect == "postgresql":
+        vector = literal_column(f"{table.name}.{info['column']}_search")
+        tsquery = func.to_tsquery(
+            cast(literal(info["config"]), REGCONFIG),
+            " & ".join(f"{t}:*" for t in terms),
+        )
+        # ts_rank is higher for better matches
+        rank = -func.ts_rank(vector, tsquery, type_=Float)
+        query = select(model, rank.label("search_rank")).where(
+            vector.op("@@")(tsquery)
+        )
+    elif dialect == "sqlite":
+        fts = sa_table(f"{table.name}_fts", sa_column("rowid"))
+        # FTS5 matches and ranks against the table name as a column
+        fts_name = literal_column(fts.name)
+        # bm25 is lower for better matches
+        rank = func.bm25(fts_name, type_=Float)
+        query = (
+            select(model, rank.label("search_rank"))
+            .join(fts, fts.c.rowid == literal_column(f"{table.name}.rowid"))
+            .where(fts_name.op("MATCH")(" ".join(f'"{t}"*' for t in terms)))
+        )
+    else:
+        raise NotImplementedError(f"Full-text search is not supported on {dialect}")
+    return query
@@ -1,5 +1,14 @@
 from sqlalchemy import Column, DateTime
-from datetime import datetime
+from datetime import datetime, timezone
+
+
+# Timestamps are stored as naive utc datetimes. Convert a datetime given by
+# a client, e.g. `2024-10-18T10:47:01Z`, before comparing it to them, naive
+# values are taken as utc already.
+def naive_utc(value: datetime) -> datetime:
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
 
 
 # add autotimestamp support for models
@@ -9,4 +18,11 @@ class AutoTimestampMixin:
     # ! note that `server_default` takes a SQL expression
     # the python type for `DateTime` columns is datetime.datetime
     created_at = Column(DateTime, nullable=False, default=lambda: datetime.utcnow())
-    updated_at = Column(DateTime, default=lambda: datetime.utcnow())
+    # `onupdate` sets updated_at on every ORM flush of a changed row, and on
+    # every `update()` statement (including `CrudMixin.update` and bulk
+    # updates) that doesn't set it explicitly
+    updated_at = Column(
+        DateTime,
+        default=lambda: datetime.utcnow(),
+        onupdate=lambda: datetime.utcnow(),
+    )
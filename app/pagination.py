@@ -0,0 +1,188 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, literal, or_, tuple_
+
+# keyset (cursor) pagination support
+#
+# LIMIT/OFFSET paging makes the database scan and discard every row before
+# the requested offset, so page N costs N times page 1. Keyset paging instead
+# remembers the sort key of the last row returned and asks for rows strictly
+# after it, which is an index range scan no matter how deep the page is.
+#
+# All list queries are ordered by `(created_at, id)`: `created_at` gives a
+# natural insertion order and `id` breaks ties between rows created in the
+# same microsecond, so the order is total and stable between calls.
+# A composite index on the same columns is declared in `models.py`.
+#
+# The cursor token is opaque to clients: a urlsafe base64 encoded json array
+# of the last row's `created_at` and `id`. Other `(timestamp, id)` orderings,
+# such as `(updated_at, id)` for the todo changes feed, use the same cursor.
+# Search results are ordered by `(rank, id)` and use a rank cursor instead.
+#
+# List endpoints also take a `sort` parameter, a comma separated list of
+# sort keys, each optionally prefixed with `-` for descending order, e.g.
+# `sort=completed,-created_at`. Sort keys are whitelisted per model in
+# `__sortable__`, and `id` is always added as the last key to break ties,
+# after the columns following the last sort key in its index, e.g.
+# `sort=lname` orders by `(lname, fname, id)`.
+# The cursor then holds the last row's values of all sort keys. Keyset
+# comparisons assume sort key values are never null, which the schemas
+# ensure for the whitelisted columns.
+
+
+def encode_token(values: list) -> str:
+    raw = json.dumps(values, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_token(token: str) -> list:
+    # restore base64 padding stripped by encode_token
+    padded = token + "=" * (-len(token) % 4)
+    try:
+        return json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {token}")
+
+
+def encode_cursor(ts: datetime, id: str) -> str:
+    return encode_token([ts.isoformat(), id])
+
+
+def decode_cursor(token: str) -> tuple[datetime, str]:
+    try:
+        ts, id = decode_token(token)
+        return datetime.fromisoformat(ts), str(id)
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor: {token}")
+
+
+def encode_rank_cursor(rank: float, id: str) -> str:
+    return encode_token([rank, id])
+
+
+def decode_rank_cursor(token: str) -> tuple[float, str]:
+    try:
+        rank, id = decode_token(token)
+        return float(rank), str(id)
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor: {token}")
+
+
+def parse_sort(sort: str | None, sortable=None) -> list[tuple[str, bool]]:
+    """
+    Parse a sort parameter to a list of `(key, descending)` pairs.
+    :param sort: comma separated sort keys, `-` prefixed for descending order
+    :param sortable: allowed sort keys, any key is allowed when None
+    :return: list of (key, descending)
+    """
+    if not sort:
+        return []
+    order = []
+    for item in sort.split(","):
+        item = item.strip()
+        key = item.lstrip("+-")
+        if not key or (sortable is not None and key not in sortable):
+            raise ValueError(f"Invalid sort key: {key}")
+        if key in [k for k, _ in order]:
+            raise ValueError(f"Duplicate sort key: {key}")
+        order.append((key, item.startswith("-")))
+    return order
+
+
+def sort_order(sort: str | None, keys=("created_at", "id"), sortable=None):
+    # full order of a sort parameter: the sort keys, `keys[0]` when none are
+    # given, the columns following the last key in its index when sortable
+    # maps them, and the id key last, in the direction of the key before it
+    order = parse_sort(sort, sortable) or [(keys[0], False)]
+    last, desc = order[-1]
+    following = sortable.get(last, ()) if isinstance(sortable, dict) else ()
+    sorted_keys = {key for key, _ in order}
+    order += [(key, desc) for key in following if key not in sorted_keys]
+    return order + [(keys[1], desc)]
+
+
+def keyset_after(columns: list, descending: list[bool], values: list):
+    # Select rows sorting after values. With a single direction, it is a
+    # row value comparison the database matches to an index range scan,
+    # mixed directions are expanded to
+    # `c1 > v1 OR (c1 = v1 AND c2 > v2) OR ...`.
+    # Values are bound with the column type, as booleans can't be compared
+    # with `>` or `<` as python literals.
+    values = [literal(v, c.type) for c, v in zip(columns, values)]
+    if len(set(descending)) == 1:
+        if descending[0]:
+            return tuple_(*columns) < tuple_(*values)
+        return tuple_(*columns) > tuple_(*values)
+    clauses = []
+    for i, (column, desc, value) in enumerate(zip(columns, descending, values)):
+        after = column < value if desc else column > value
+        clauses.append(
+            and_(*[c == v for c, v in zip(columns[:i], values[:i])], after)
+        )
+    return or_(*clauses)
+
+
+def cursor_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def decode_keyset(token: str, columns: list) -> list:
+    # decode the sort key values of a cursor, json values are converted back
+    # to the python type of their column
+    values = decode_token(token)
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError(f"Invalid cursor: {token}")
+    try:
+        return [
+            datetime.fromisoformat(v) if c.type.python_type is datetime else v
+            for c, v in zip(columns, values)
+        ]
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor: {token}")
+
+
+def paginate(
+    query,
+    model,
+    after: str | None = None,
+    keys=("created_at", "id"),
+    sort: str | None = None,
+):
+    """
+    Apply the stable `(created_at, id)` ordering, or the `sort` ordering, to
+    a select query, and when an `after` cursor is given, only select rows
+    that sort after it.
+    :param query: select query on model
+    :param model: orm model class with `created_at` and `id` columns
+    :param after: opaque cursor token returned as next cursor of a prior page
+    :param keys: names of the (timestamp, id) columns to order by
+    :param sort: sort parameter, validated against `model.__sortable__`
+    :return: query
+    """
+    order = sort_order(sort, keys, getattr(model, "__sortable__", ()))
+    columns = [getattr(model, key) for key, _ in order]
+    descending = [desc for _, desc in order]
+    if after:
+        values = decode_keyset(after, columns)
+        query = query.where(keyset_after(columns, descending, values))
+    return query.order_by(
+        *[c.desc() if desc else c for c, desc in zip(columns, descending)]
+    )
+
+
+def next_cursor(
+    rows: list,
+    limit: int,
+    keys=("created_at", "id"),
+    sort: str | None = None,
+    model=None,
+) -> str | None:
+    # a short page means there is nothing left to fetch, the cursor holds the
+    # keys of the order `paginate` applied for the same model and sort
+    if not rows or len(rows) < limit:
+        return None
+    last = rows[-1]
+    order = sort_order(sort, keys, getattr(model, "__sortable__", None))
+    return encode_token([cursor_value(getattr(last, key)) for key, _ in order])
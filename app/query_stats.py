@@ -0,0 +1,131 @@
+import logging
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# per request sql query statistics
+#
+# Engine cursor events record each statement into the `QueryStats` of the
+# current request, found in a context variable set by `QueryStatsMiddleware`.
+# SQLAlchemy runs the sync session code of an AsyncSession in a greenlet that
+# shares the context of the calling task, so statements are attributed to
+# the request that awaited them.
+#
+# Each response carries a `Server-Timing` header with the number of queries,
+# the rows written and the total time spent in the database, e.g.
+# `db;dur=4.12;desc="3 queries, 1 rows written"`, shown by browser dev tools.
+# The rows read by a select are not known when the statement returns, only
+# when they are fetched, so they are not counted.
+#
+# The same select statement executed `DB_NPLUS1_THRESHOLD` times or more
+# within one request is logged as a probable N+1 query, e.g. a relationship
+# lazy loaded for each row of a list, and reported in `Server-Timing` as
+# `nplus1`. Repeated writes, such as the chunks of an import, are expected.
+#
+# With `DB_QUERY_BUDGET` set, requests executing more queries are logged, and
+# with `DB_QUERY_BUDGET_STRICT=true` they fail with `QueryBudgetExceeded`,
+# to make tests fail when a route exceeds its budget.
+
+query_stats: ContextVar["QueryStats"] = ContextVar("query_stats", default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def record(self, statement: str, rowcount: int, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        # rowcount is -1 for selects
+        if rowcount > 0:
+            self.rows += rowcount
+        if statement.lstrip()[:6].upper() == "SELECT":
+            self.statements[statement] += 1
+
+    def repeated(self, threshold: int) -> dict:
+        # select statements executed at least threshold times
+        return {s: n for s, n in self.statements.items() if n >= threshold}
+
+    def server_timing(self, threshold: int) -> str:
+        timing = (
+            f"db;dur={self.seconds * 1000:.2f};"
+            f'desc="{self.count} queries, {self.rows} rows written"'
+        )
+        repeated = self.repeated(threshold)
+        if repeated:
+            timing += f', nplus1;desc="{len(repeated)} repeated statements"'
+        return timing
+
+
+def instrument_engine(engine: AsyncEngine):
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        if query_stats.get() is not None:
+            conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        stats = query_stats.get()
+        if stats is None or not conn.info.get("query_started"):
+            return
+        seconds = time.perf_counter() - conn.info["query_started"].pop()
+        stats.record(statement, cursor.rowcount, seconds)
+
+
+# Pure ASGI middleware, unlike a `BaseHTTPMiddleware` it runs the route in
+# the same task, so the context variable it sets is seen by the route.
+class QueryStatsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.nplus1_threshold = settings.db_nplus1_threshold
+        self.budget = settings.db_query_budget
+        self.strict = settings.db_query_budget_strict
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = QueryStats()
+        token = query_stats.set(stats)
+
+        async def send_with_stats(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                timing = stats.server_timing(self.nplus1_threshold)
+                headers.append((b"server-timing", timing.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            query_stats.reset(token)
+        self.check(scope, stats)
+
+    def check(self, scope, stats: QueryStats):
+        route = f"{scope['method']} {scope['path']}"
+        for statement, n in stats.repeated(self.nplus1_threshold).items():
+            logger.warning(
+                "Probable N+1 query in %s, executed %d times: %s", route, n, statement
+            )
+        if self.budget is not None and stats.count > self.budget:
+            message = (
+                f"{route} executed {stats.count} queries, "
+                f"over the budget of {self.budget}"
+            )
+            if self.strict:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
@@ -1,35 +1,279 @@
-from fastapi import APIRouter, Depends
+import time
+from datetime import datetime
+from typing import Literal
+from fastapi import APIRouter, Body, Depends, Query, Request, Response
 from fastapi import HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.exc import StaleDataError
 from app.db import get_db_session
+from app.routing import UnitOfWorkRoute
 from .. import schemas
 from .. import crud_todo
+from ..pagination import encode_cursor, encode_rank_cursor, next_cursor
+from ..export import export_response
+from ..serializers import ListSerializer
+from ..loaders import Loaders, get_loaders
+from ..singleflight import SingleFlight
+from ..importer import csv_records, ndjson_records
+from ..etag import compute_etag, compute_last_modified, is_conditional
+from ..etag import is_not_modified, not_modified_response, set_validators
+from ..models import Todo
+from ..models_timestamp import naive_utc
 
-router = APIRouter(prefix="/api/todos", dependencies=[])
+# routes release the request session before serializing their response
+router = APIRouter(prefix="/api/todos", dependencies=[], route_class=UnitOfWorkRoute)
+
+todo_list = ListSerializer(
+    schemas.TodoReadNested, columns=list(schemas.TodoRead.model_fields)
+)
+
+
+# versions of the distinct owners of a page, in a stable order for the etag
+def owner_versions(owners) -> list:
+    return sorted({(u.id, u.updated_at) for u in owners if u is not None})
 
 
 # @router.get("/")
 # @router.get("/", response_model=list[schemas.TodoReadNested])
-@router.get("/", response_model=list[schemas.TodoRead])
+# The todos are nested with their owner, the owners of a page are loaded
+# with one batched query, see `loaders.py`.
+@router.get("/", response_model=list[schemas.TodoReadNested])
 async def read_todos(
+    request: Request,
     user_id: str = None,
     offset: int = 0,
     limit: int = 10,
+    after: str | None = None,
+    completed: bool | None = None,
+    owner_id: list[str] = Query(None),
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+    sort: str | None = None,
+    db: AsyncSession = Depends(get_db_session),
+    loaders: Loaders = Depends(get_loaders),
+):
+    # opt-in keyset pagination: a full page carries the cursor of its last row
+    # in `X-Next-Cursor`, pass it back as `after` to fetch the following page,
+    # with the same `sort`
+    filters = []
+    if completed is not None:
+        filters.append(("completed", "eq", completed))
+    if owner_id:
+        filters.append(("owner_id", "in", owner_id))
+    if created_after:
+        filters.append(("created_at", "ge", naive_utc(created_after)))
+    if created_before:
+        filters.append(("created_at", "lt", naive_utc(created_before)))
+    try:
+        # for conditional requests, check the page row versions first and
+        # answer 304 without loading the rows when nothing changed, the
+        # version of the page covers the nested owners
+        if is_conditional(request):
+            rows = await crud_todo.get_todo_rows(
+                db,
+                ["id", "updated_at", "owner_id"],
+                user_id,
+                offset=offset,
+                limit=limit,
+                after=after,
+                filters=filters,
+                sort=sort,
+            )
+            owners = await loaders.users.load_many({r.owner_id for r in rows})
+            versions = [(r.id, r.updated_at) for r in rows] + owner_versions(owners)
+            etag = compute_etag(versions)
+            last_modified = compute_last_modified(versions)
+            if is_not_modified(request, etag, last_modified):
+                return not_modified_response(etag, last_modified)
+        # read-only fast path, see `serializers.py`
+        todos = await crud_todo.get_todo_rows(
+            db,
+            todo_list.columns,
+            user_id,
+            offset=offset,
+            limit=limit,
+            after=after,
+            filters=filters,
+            sort=sort,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    owners = await loaders.users.load_many([t.owner_id for t in todos])
+    response = todo_list.response(
+        [{**t._mapping, "owner": owner} for t, owner in zip(todos, owners)]
+    )
+    cursor = next_cursor(todos, limit, sort=sort, model=Todo)
+    if cursor:
+        response.headers["X-Next-Cursor"] = cursor
+    versions = [(t.id, t.updated_at) for t in todos] + owner_versions(owners)
+    set_validators(response, compute_etag(versions), compute_last_modified(versions))
+    return response
+
+
+# Import todos from a raw NDJSON or CSV request body (not a multipart form,
+# which would be buffered), e.g.
+# `curl --data-binary @todos.ndjson -H "Content-Type: application/x-ndjson"`.
+# The format defaults to csv for a `text/csv` content type, ndjson otherwise.
+@router.post("/import", response_model=schemas.TodoImportReport)
+async def import_todos(
+    request: Request,
+    format: Literal["ndjson", "csv"] | None = None,
+    chunk_size: int = Query(crud_todo.IMPORT_CHUNK_SIZE, ge=1, le=50000),
     db: AsyncSession = Depends(get_db_session),
 ):
-    if user_id:
-        todos = await crud_todo.get_user_todos(db, user_id, offset=offset, limit=limit)
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "csv" if content_type.startswith("text/csv") else "ndjson"
+    if format == "csv":
+        records = csv_records(request.stream())
+    else:
+        records = ndjson_records(request.stream())
+    started = time.perf_counter()
+    report = await crud_todo.import_todos(db, records, chunk_size=chunk_size)
+    elapsed = time.perf_counter() - started
+    report["elapsed_seconds"] = elapsed
+    report["rows_per_second"] = report["imported"] / elapsed if elapsed else 0
+    return report
+
+
+# Incremental sync: todos changed (updated or deleted) after a watermark.
+# Start with `since` (or nothing for a full sync), then pass the returned
+# `cursor` back as `cursor` until `has_more` is false, and keep the last
+# cursor as the watermark of the next sync.
+@router.get("/changes", response_model=schemas.TodoChanges)
+async def read_todo_changes(
+    user_id: str = None,
+    since: datetime | None = None,
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db_session),
+):
+    try:
+        changes, until = await crud_todo.get_todo_changes(
+            db, user_id, since=since, after=cursor, limit=limit
+        )
+    except crud_todo.ChangesExpired as e:
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    has_more = len(changes) == limit
+    if has_more:
+        cursor = encode_cursor(changes[-1]["changed_at"], changes[-1]["id"])
     else:
-        todos = await crud_todo.get_todos(db, offset=offset, limit=limit)
-    return todos
+        # caught up, the watermark is the end of the complete part of the feed
+        cursor = encode_cursor(until, "")
+    return {"changes": changes, "cursor": cursor, "has_more": has_more}
+
+
+# Full-text search of todo text, best matches first. Every word of `q` must
+# match, as a word prefix. A full page carries the cursor of its last row in
+# `X-Next-Cursor`, pass it back as `after` to fetch the following page.
+@router.get("/search", response_model=list[schemas.TodoRead])
+async def search_todos(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    user_id: str = None,
+    limit: int = Query(10, ge=1, le=100),
+    after: str | None = None,
+    db: AsyncSession = Depends(get_db_session),
+):
+    if not crud_todo.SEARCH_SUPPORTED:
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="Full-text search is not supported by the database",
+        )
+    try:
+        rows = await crud_todo.search_todos(
+            db, q, user_id=user_id, limit=limit, after=after
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if len(rows) == limit:
+        todo, rank = rows[-1]
+        response.headers["X-Next-Cursor"] = encode_rank_cursor(rank, todo.id)
+    return [todo for todo, _ in rows]
+
+
+# Todo counts, in total and per owner, optionally for the given owners only.
+@router.get("/stats", response_model=schemas.TodoStats)
+async def read_todo_stats(
+    owner_id: list[str] = Query(None), db: AsyncSession = Depends(get_db_session)
+):
+    return await crud_todo.get_todo_stats(db, owner_id)
+
+
+# Stream all todos, or the todos of `user_id`, as NDJSON or CSV.
+@router.get("/export")
+async def export_todos(
+    user_id: str = None, format: Literal["ndjson", "csv"] = "ndjson"
+):
+    return export_response(
+        crud_todo.stream_todos(user_id),
+        crud_todo.EXPORT_COLUMNS,
+        format,
+        filename="todos",
+    )
+
+
+# Bulk routes are declared before the `/{id}` routes, otherwise
+# `DELETE /bulk` would be matched by `DELETE /{id}` with id "bulk".
+
+
+def check_bulk_size(items: list):
+    if not items:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="No items given."
+        )
+    if len(items) > crud_todo.BULK_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Too many items, max is {crud_todo.BULK_MAX_ITEMS}.",
+        )
+
+
+@router.post("/bulk", response_model=list[schemas.TodoBulkResult])
+async def create_todos(
+    todos_data: list[schemas.TodoCreate], db: AsyncSession = Depends(get_db_session)
+):
+    check_bulk_size(todos_data)
+    return await crud_todo.create_todos(db, todos_data)
+
+
+@router.patch("/bulk", response_model=list[schemas.TodoBulkResult])
+async def update_todos(
+    todos_data: list[schemas.TodoUpdate], db: AsyncSession = Depends(get_db_session)
+):
+    check_bulk_size(todos_data)
+    return await crud_todo.update_todos(db, todos_data)
+
+
+@router.delete("/bulk", response_model=list[schemas.TodoBulkResult])
+async def delete_todos(
+    ids: list[str] = Body(...), db: AsyncSession = Depends(get_db_session)
+):
+    check_bulk_size(ids)
+    return await crud_todo.delete_todos(db, ids)
+
+
+# concurrent reads of the same todo share one lookup, see `singleflight.py`
+todo_flight = SingleFlight("GET /api/todos/{id}")
 
 
 # @router.get("/{id}", response_model=schemas.TodoRead)
 @router.get("/{id}", response_model=schemas.TodoReadNested)
-async def read_todo(id: str):
-    todo = await crud_todo.get_todo(id)
+async def read_todo(id: str, request: Request, response: Response):
+    todo = await todo_flight.do(id, lambda: crud_todo.get_todo(id))
     if not todo:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    # the nested owner is part of the representation, so is its version
+    versions = [(todo.id, todo.updated_at)]
+    if todo.owner:
+        versions.append((todo.owner.id, todo.owner.updated_at))
+    etag = compute_etag(versions)
+    last_modified = compute_last_modified(versions)
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    set_validators(response, etag, last_modified)
     return todo
 
 
@@ -49,11 +293,27 @@ async def create_todo(
 async def update_todo(
     id: str, todo_data: schemas.TodoUpdate, db: AsyncSession = Depends(get_db_session)
 ):
-    todo = await crud_todo.update_todo(db, id, todo_data)
+    try:
+        todo = await crud_todo.update_todo(db, id, todo_data)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     if not todo:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="Bad Request"
-        )
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return todo
+
+
+@router.patch("/{id}", response_model=schemas.TodoRead)
+async def patch_todo(
+    id: str, todo_data: schemas.TodoPatch, db: AsyncSession = Depends(get_db_session)
+):
+    try:
+        todo = await crud_todo.update_todo(db, id, todo_data)
+    except StaleDataError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if not todo:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
     return todo
 
 
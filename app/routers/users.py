@@ -1,38 +1,193 @@
-from fastapi import APIRouter, Depends
+from typing import Literal
+from fastapi import APIRouter, Depends, Query, Request, Response
 from fastapi import HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.db import get_db_session
+from app.db import ReadSessionLocal, get_db_session
+from app.routing import UnitOfWorkRoute
 from .. import schemas
 from .. import crud_user
+from .. import crud_todo
+from ..pagination import next_cursor
+from ..models import User
+from ..export import export_response
+from ..serializers import ListSerializer
+from ..loaders import Loaders, get_loaders
+from ..singleflight import SingleFlight
+from ..etag import compute_etag, compute_last_modified, is_conditional
+from ..etag import is_not_modified, not_modified_response, set_validators
 
-router = APIRouter(prefix="/api/users", dependencies=[])
+# routes release the request session before serializing their response
+router = APIRouter(prefix="/api/users", dependencies=[], route_class=UnitOfWorkRoute)
 
+user_list = ListSerializer(
+    schemas.UserReadNested, columns=list(schemas.UserRead.model_fields)
+)
 
-# @router.get("/", response_model=list[schemas.UserReadNested])
-@router.get("/", response_model=list[schemas.UserRead])
+
+# versions of the nested todos of a page, a list of todos per user
+def nested_todo_versions(todos) -> list:
+    return [(t.id, t.updated_at) for user_todos in todos for t in user_todos]
+
+
+# Each user is nested with the first `todos_limit` of its todos, none by
+# default, the todos of all users of the page are loaded with one batched
+# query, see `loaders.py`. `todos_next_cursor` is the `todos_cursor` of the
+# next page of the user todos in `GET /api/users/{id}`.
+@router.get("/", response_model=list[schemas.UserReadNested])
 async def read_users(
+    request: Request,
     offset: int = 0,
     limit: int = 10,
+    after: str | None = None,
+    sort: str | None = None,
+    todos_limit: int = Query(0, ge=0, le=100),
     db: AsyncSession = Depends(get_db_session),
+    loaders: Loaders = Depends(get_loaders),
 ):
-    return await crud_user.get_users(db, offset=offset, limit=limit)
+    # opt-in keyset pagination, sorting and conditional GET, see `read_todos`
+    async def load_todos(user_ids) -> list:
+        if not todos_limit:
+            return [[] for _ in user_ids]
+        return await loaders.todos_by_owner(todos_limit).load_many(user_ids)
+
+    try:
+        if is_conditional(request):
+            versions = await crud_user.get_users_versions(
+                db, offset=offset, limit=limit, after=after, sort=sort
+            )
+            todos = await load_todos([v.id for v in versions])
+            versions += nested_todo_versions(todos)
+            etag = compute_etag(versions)
+            last_modified = compute_last_modified(versions)
+            if is_not_modified(request, etag, last_modified):
+                return not_modified_response(etag, last_modified)
+        # read-only fast path, see `serializers.py`
+        users = await crud_user.get_user_rows(
+            db, user_list.columns, offset=offset, limit=limit, after=after, sort=sort
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    todos = await load_todos([u.id for u in users])
+    response = user_list.response(
+        [
+            {
+                **u._mapping,
+                "todos": user_todos,
+                "todos_next_cursor": next_cursor(user_todos, todos_limit),
+            }
+            for u, user_todos in zip(users, todos)
+        ]
+    )
+    cursor = next_cursor(users, limit, sort=sort, model=User)
+    if cursor:
+        response.headers["X-Next-Cursor"] = cursor
+    versions = [(u.id, u.updated_at) for u in users]
+    versions += nested_todo_versions(todos)
+    set_validators(response, compute_etag(versions), compute_last_modified(versions))
+    return response
 
 
 @router.get("/crudmixin/", response_model=list[schemas.UserRead])
 async def read_users_with_crudmixin(
+    response: Response,
     offset: int = 0,
     limit: int = 10,
+    after: str | None = None,
+    sort: str | None = None,
     db: AsyncSession = Depends(get_db_session),
 ):
-    return await crud_user.get_users_with_crudmixin(db, offset=offset, limit=limit)
+    try:
+        users = await crud_user.get_users_with_crudmixin(
+            db, offset=offset, limit=limit, after=after, sort=sort
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    cursor = next_cursor(users, limit, sort=sort, model=User)
+    if cursor:
+        response.headers["X-Next-Cursor"] = cursor
+    return users
 
 
+# Load a user, its todos count and a page of its todos in a session of its
+# own, to be shared by concurrent identical requests, see `singleflight.py`.
+async def load_user_page(id: str, todos_limit: int, todos_cursor: str | None):
+    async with ReadSessionLocal() as db:
+        user, todos_count = await crud_user.get_user_with_todos_count(db, id)
+        if not user:
+            return None
+        todos = await crud_todo.get_user_todos(
+            db, id, limit=todos_limit, after=todos_cursor
+        )
+    return user, todos_count, todos
+
+
+user_flight = SingleFlight("GET /api/users/{id}")
+
+
+# The nested todos are paginated: `todos_limit` caps the page size and
+# `todos_cursor` is the `todos_next_cursor` of the previous page.
+# Concurrent identical requests share one load, so conditional requests
+# are checked against the loaded page rather than a separate versions query.
 @router.get("/{id}", response_model=schemas.UserReadNested)
-async def read_user(id: str, db: AsyncSession = Depends(get_db_session)):
-    user = await crud_user.get_user(db, id)
-    if not user:
+async def read_user(
+    id: str,
+    request: Request,
+    response: Response,
+    todos_limit: int = Query(10, ge=0, le=100),
+    todos_cursor: str | None = None,
+):
+    try:
+        page = await user_flight.do(
+            (id, todos_limit, todos_cursor),
+            lambda: load_user_page(id, todos_limit, todos_cursor),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if not page:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
-    return user
+    user, todos_count, todos = page
+    # the representation version covers the user, its todos count and the
+    # versions of the nested todos page
+    versions = [(user.id, todos_count, user.updated_at)]
+    versions += [(t.id, t.updated_at) for t in todos]
+    etag = compute_etag(versions)
+    last_modified = compute_last_modified(versions)
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    set_validators(response, etag, last_modified)
+    user_data = schemas.UserRead.model_validate(user, from_attributes=True)
+    return {
+        **user_data.model_dump(),
+        "todos": todos,
+        "todos_count": todos_count,
+        "todos_next_cursor": next_cursor(todos, todos_limit),
+    }
+
+
+# per user variant of `GET /api/todos/stats`
+@router.get("/{id}/stats", response_model=schemas.UserTodoCounts)
+async def read_user_stats(id: str, db: AsyncSession = Depends(get_db_session)):
+    if not await crud_user.user_exists(db, id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    stats = await crud_todo.get_todo_stats(db, [id])
+    return {**stats, "owner_id": id}
+
+
+# per user variant of `GET /api/todos/export`
+@router.get("/{id}/todos/export")
+async def export_user_todos(
+    id: str,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    db: AsyncSession = Depends(get_db_session),
+):
+    if not await crud_user.user_exists(db, id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return export_response(
+        crud_todo.stream_todos(id),
+        crud_todo.EXPORT_COLUMNS,
+        format,
+        filename=f"todos-{id}",
+    )
 
 
 @router.get("/crudmixin/{id}", response_model=schemas.UserRead)
@@ -50,6 +205,7 @@ async def filter_users(
     fname: str | None = None,
     offset: int = 0,
     limit: int = 10,
+    sort: str | None = None,
     db: AsyncSession = Depends(get_db_session),
 ):
     filter_conditions = []
@@ -59,9 +215,12 @@ async def filter_users(
         filter_conditions.append(("lname", "ilike", lname))
     if fname:
         filter_conditions.append(("fname", "ilike", fname))
-    return await crud_user.filter_users(
-        db, filter_conditions, offset=offset, limit=limit
-    )
+    try:
+        return await crud_user.filter_users(
+            db, filter_conditions, offset=offset, limit=limit, sort=sort
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
 @router.post("/signup/", response_model=schemas.UserRead)
@@ -0,0 +1,38 @@
+import asyncio
+import functools
+
+from fastapi.routing import APIRoute
+
+from .db import request_session
+
+# routes releasing the request session before serialization
+#
+# Routes of a `UnitOfWorkRoute` router close the request session opened by
+# `db.get_db_session` as soon as the route returns, before the response model
+# serializes the result: the connection is back in the pool while the
+# response is built and sent. Write routes have committed by then, their
+# connection is released on commit. Instances stay usable after close with
+# the attributes they loaded, a lazy load fails instead of checking out a new
+# connection.
+
+
+def release_session_after(endpoint):
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await endpoint(*args, **kwargs)
+        finally:
+            db = request_session.get()
+            if db is not None:
+                await db.close()
+
+    return wrapper
+
+
+# route class closing the request session when the route returns, use with
+# `APIRouter(route_class=UnitOfWorkRoute)`
+class UnitOfWorkRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            endpoint = release_session_after(endpoint)
+        super().__init__(path, endpoint, **kwargs)
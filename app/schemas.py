@@ -47,6 +47,16 @@ class TodoUpdate(TodoCreate):
     id: str
 
 
+# partial update, only the fields set are updated, with `updated_at` set the
+# update fails with 409 Conflict if the todo was updated since
+# the defaults only mark fields as unset, explicit nulls are rejected
+class TodoPatch(BaseModel):
+    owner_id: str = None
+    text: str = None
+    completed: bool = None
+    updated_at: datetime | None = None
+
+
 class TodoRead(TodoUpdate):
     owner_id: str
     # owner: UserRead
@@ -57,14 +67,82 @@ class TodoRead(TodoUpdate):
         orm_mode = True
 
 
+# bulk write operations report one result per input item, in input order
+
+
+class TodoBulkResult(BaseModel):
+    index: int
+    ok: bool
+    id: str | None = None
+    detail: str | None = None
+    todo: TodoRead | None = None
+
+
+class TodoImportError(BaseModel):
+    line: int
+    detail: str
+
+
+# `errors` holds the details of the first failed records only
+class TodoImportReport(BaseModel):
+    received: int
+    imported: int
+    failed: int
+    chunks: int
+    errors: list[TodoImportError]
+    elapsed_seconds: float
+    rows_per_second: float
+
+
+# A change of the todo changes feed, either an upsert with the todo data, or
+# a deletion of the todo with the given id.
+class TodoChange(BaseModel):
+    id: str
+    deleted: bool
+    changed_at: datetime
+    todo: TodoRead | None = None
+
+
+# `cursor` is the position after the last change, pass it back as `cursor`
+# for the next page, or keep it as the watermark of the next sync
+class TodoChanges(BaseModel):
+    changes: list[TodoChange]
+    cursor: str | None = None
+    has_more: bool
+
+
+# todo counts computed in the database, `open` counts todos not completed
+
+
+class TodoCounts(BaseModel):
+    total: int
+    open: int
+    completed: int
+
+
+class UserTodoCounts(TodoCounts):
+    owner_id: str | None = None
+
+
+# totals over all todos, and the counts of each owner with todos
+class TodoStats(TodoCounts):
+    owners: list[UserTodoCounts]
+
+
 # nested view model includes child orm objects
 
 
 # be careful to only use UserRead, not UserReadNested
 # otherwise it will lead to endless circular lazy loading...
+# `owner` is null when the owner doesn't exist, `owner_id` isn't enforced as
+# a foreign key on every database
 class TodoReadNested(TodoRead):
-    owner: UserRead
+    owner: UserRead | None = None
 
 
+# `todos` holds one page of the user's todos, `todos_count` is the total
+# number of todos and `todos_next_cursor` is the cursor of the next page
 class UserReadNested(UserRead):
     todos: list[TodoRead]
+    todos_count: int | None = None
+    todos_next_cursor: str | None = None
@@ -1,5 +1,10 @@
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
 from passlib.context import CryptContext
 from sqlalchemy.orm import Session
+from .config import settings
 from .models import User
 
 
@@ -14,6 +19,80 @@ def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 
+# bcrypt is deliberately slow (~250ms at cost 12), calling the functions above
+# in an async route blocks the event loop and stalls every other request of
+# the worker. The async versions below run them in a bounded worker pool.
+
+_hash_executor: Executor = None
+_hash_semaphore: asyncio.Semaphore = None
+
+# hash pool usage counters
+hash_pool_stats = {
+    # calls waiting for a free slot
+    "queued": 0,
+    # calls running in the pool
+    "running": 0,
+    "completed": 0,
+    # total seconds calls spent waiting in queue
+    "wait_seconds": 0.0,
+}
+
+
+def get_hash_executor() -> Executor:
+    global _hash_executor
+    if _hash_executor is None:
+        if settings.password_hash_executor == "process":
+            _hash_executor = ProcessPoolExecutor(
+                max_workers=settings.password_hash_workers
+            )
+        else:
+            _hash_executor = ThreadPoolExecutor(
+                max_workers=settings.password_hash_workers,
+                thread_name_prefix="password-hash",
+            )
+    return _hash_executor
+
+
+def shutdown_hash_executor():
+    global _hash_executor
+    if _hash_executor is not None:
+        _hash_executor.shutdown(wait=False, cancel_futures=True)
+        _hash_executor = None
+
+
+async def run_in_hash_pool(fn, *args):
+    global _hash_semaphore
+    if _hash_semaphore is None:
+        _hash_semaphore = asyncio.Semaphore(settings.password_hash_max_concurrency)
+    loop = asyncio.get_running_loop()
+
+    hash_pool_stats["queued"] += 1
+    queued_at = time.perf_counter()
+    try:
+        await _hash_semaphore.acquire()
+    finally:
+        hash_pool_stats["queued"] -= 1
+    hash_pool_stats["wait_seconds"] += time.perf_counter() - queued_at
+
+    hash_pool_stats["running"] += 1
+    try:
+        # module level functions are passed to the executor, so that they
+        # can be pickled for a process pool
+        return await loop.run_in_executor(get_hash_executor(), fn, *args)
+    finally:
+        hash_pool_stats["running"] -= 1
+        hash_pool_stats["completed"] += 1
+        _hash_semaphore.release()
+
+
+async def get_password_hash_async(password: str) -> str:
+    return await run_in_hash_pool(get_password_hash, password)
+
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    return await run_in_hash_pool(verify_password, plain_password, hashed_password)
+
+
 def authenticate_user(db: Session, username: str, password: str):
     user = db.query(User).filter(User.username == username).first()
     print(f"authenticate user: {user}")
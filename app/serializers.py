@@ -0,0 +1,31 @@
+from fastapi import Response
+from pydantic import TypeAdapter
+
+# fast path serialization of read-only list endpoints
+#
+# When a route returns ORM instances, FastAPI validates each of them against
+# the response model with `from_attributes`, then converts the models with
+# `jsonable_encoder` and dumps them with `json.dumps`, all in python, and
+# the instances themselves are built and tracked by the session first.
+#
+# List routes instead select only the response model columns as Core rows
+# and serialize the page with a prebuilt `TypeAdapter`, which validates and
+# dumps the whole list to json in pydantic-core. The route `response_model`
+# still documents the response, FastAPI doesn't apply it to a `Response`.
+# See `benchmarks/serialization.py` for the difference.
+
+
+class ListSerializer:
+    def __init__(self, schema, columns: list[str] = None):
+        self.adapter = TypeAdapter(list[schema])
+        # columns to select, named as the response model fields, unless the
+        # model has nested fields loaded separately
+        self.columns = columns or list(schema.model_fields)
+
+    def dump_json(self, rows) -> bytes:
+        return self.adapter.dump_json(
+            self.adapter.validate_python(rows, from_attributes=True)
+        )
+
+    def response(self, rows) -> Response:
+        return Response(self.dump_json(rows), media_type="application/json")
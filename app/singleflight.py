@@ -0,0 +1,80 @@
+import asyncio
+
+from .config import settings
+from .db import without_request_session
+from .metrics import singleflight_fan_in, singleflight_requests_total
+
+# request coalescing (single flight) of identical reads
+#
+# Concurrent calls with the same key share one call of the load function:
+# the first caller (the leader) starts it, the next ones (followers) wait for
+# its result instead of running the same query again. Once the call is done,
+# the next caller starts a new one, results are never kept, see `cache.py`
+# for caching.
+#
+# The load runs in its own task, so a leader whose client disconnects
+# doesn't cancel it for the followers. It must not depend on the request of
+# the leader: the task runs outside of the leader request unit of work, the
+# load opens its own session, and returns instances loaded in full, detached
+# from it, that the callers only read.
+#
+# Followers wait at most `SINGLEFLIGHT_MAX_WAIT_SECONDS` for the shared
+# result, then run the load themselves.
+#
+# Metrics, per flight (the route):
+# - `singleflight_requests_total` calls by outcome, "leader", "shared" (a
+#   follower got the shared result) or "timeout" (a follower gave up waiting)
+# - `singleflight_fan_in` histogram of the number of callers of each load,
+#   the fan-in ratio is `sum / count`
+# See: https://pkg.go.dev/golang.org/x/sync/singleflight
+
+
+class Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.callers = 1
+
+
+class SingleFlight:
+    def __init__(self, name: str, max_wait: float = None):
+        self.name = name
+        self.max_wait = (
+            settings.singleflight_max_wait_seconds if max_wait is None else max_wait
+        )
+        self.flights = {}
+
+    async def do(self, key, load):
+        """
+        :param key: identifies the call, e.g. the route parameters
+        :param load: async function of no arguments, called once per flight
+        """
+        if not settings.singleflight:
+            return await load()
+        flight = self.flights.get(key)
+        if flight is None:
+            return await self._lead(key, load)
+        flight.callers += 1
+        try:
+            result = await asyncio.wait_for(
+                asyncio.shield(flight.task), self.max_wait
+            )
+        except asyncio.TimeoutError:
+            singleflight_requests_total.inc(self.name, "timeout")
+            return await load()
+        singleflight_requests_total.inc(self.name, "shared")
+        return result
+
+    async def _lead(self, key, load):
+        task = asyncio.create_task(load(), context=without_request_session())
+        flight = self.flights[key] = Flight(task)
+        task.add_done_callback(lambda t: self._done(key, flight))
+        singleflight_requests_total.inc(self.name, "leader")
+        return await asyncio.shield(task)
+
+    def _done(self, key, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        singleflight_fan_in.observe(flight.callers, self.name)
+        # retrieve the error, as no caller may be left to await the task
+        if not flight.task.cancelled():
+            flight.task.exception()
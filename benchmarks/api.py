@@ -0,0 +1,332 @@
+# load test and benchmark of the api routes
+#
+# Seeds a synthetic dataset of users x todos with `db_migration.seed_data`,
+# then drives every route of `routers/todos.py` and `routers/users.py`
+# in-process, through `httpx.AsyncClient` on the ASGI transport, with a fixed
+# number of concurrent clients. Each scenario is one route, run for a fixed
+# number of requests, and reports:
+# - throughput in requests per second
+# - p50/p95/p99 latency in milliseconds
+# - sql statements executed per request, counted with engine events
+# - non 2xx/3xx responses as errors
+#
+# The report is printed as JSON, save it and diff it across runs, e.g. before
+# and after a dependency upgrade or a loader strategy change.
+#
+# Run from the project root, the benchmark database is reset:
+#   python -m benchmarks.api --users 100 --todos-per-user 100 \
+#       --concurrency 10 --requests 500 --output report.json
+# Read only routes are run first, then the routes writing data.
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+# use a separate database, `init_tables` drops all tables
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", "sqlite+aiosqlite:///./benchmark.db")
+
+import fastapi  # noqa: E402
+import httpx  # noqa: E402
+import sqlalchemy  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.future import select  # noqa: E402
+
+from app.db import SessionLocal, engine, replicas, write_engine  # noqa: E402
+from app.db_migration import init_tables, seed_data  # noqa: E402
+from app.main import app, on_shutdown  # noqa: E402
+from app.models import Todo, User  # noqa: E402
+
+
+class QueryCounter:
+    # counts the sql statements executed by the reader, writer and replica
+    # engines
+    def __init__(self):
+        self.count = 0
+        engines = {engine, write_engine}
+        if replicas is not None:
+            engines.update(replicas.engines)
+        for e in engines:
+            event.listen(e.sync_engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    # nearest rank percentile
+    if not sorted_values:
+        return 0
+    k = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+async def run_scenario(client, counter, request, requests: int, concurrency: int):
+    """
+    Send `requests` requests built by `request(i)` with `concurrency`
+    concurrent clients.
+    :param request: function of the request number returning the keyword
+        arguments of `client.request`
+    :return: scenario report
+    """
+    numbers = iter(range(requests))
+    latencies = []
+    errors = 0
+
+    async def client_loop():
+        nonlocal errors
+        for i in numbers:
+            kwargs = request(i)
+            started = time.perf_counter()
+            r = await client.request(**kwargs)
+            latencies.append(time.perf_counter() - started)
+            if r.status_code >= 400:
+                errors += 1
+
+    queries = counter.count
+    started = time.perf_counter()
+    await asyncio.gather(*[client_loop() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    queries = counter.count - queries
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "queries_per_request": round(queries / requests, 2),
+    }
+
+
+async def load_ids(requests: int):
+    async with SessionLocal() as db:
+        user_ids = (await db.execute(select(User.id).limit(requests))).scalars()
+        todo_ids = (await db.execute(select(Todo.id).limit(requests))).scalars()
+        return user_ids.all(), todo_ids.all()
+
+
+async def create_todo_ids(client, owner_id: str, count: int) -> list[str]:
+    # todos to be deleted by the delete scenarios, created outside of them
+    ids = []
+    for i in range(0, count, 1000):
+        body = [
+            {"owner_id": owner_id, "text": f"bench {n}", "completed": False}
+            for n in range(i, min(i + 1000, count))
+        ]
+        r = await client.post("/api/todos/bulk", json=body)
+        ids += [result["id"] for result in r.json()]
+    return ids
+
+
+def read_scenarios(user_ids: list, todo_ids: list) -> dict:
+    def user(i):
+        return user_ids[i % len(user_ids)]
+
+    def todo(i):
+        return todo_ids[i % len(todo_ids)]
+
+    return {
+        "GET /api/todos/": lambda i: {"method": "GET", "url": "/api/todos/"},
+        "GET /api/todos/?user_id": lambda i: {
+            "method": "GET",
+            "url": "/api/todos/",
+            "params": {"user_id": user(i), "limit": 100},
+        },
+        "GET /api/todos/search": lambda i: {
+            "method": "GET",
+            "url": "/api/todos/search",
+            "params": {"q": f"todo {i % 10}"},
+        },
+        "GET /api/todos/stats": lambda i: {
+            "method": "GET",
+            "url": "/api/todos/stats",
+            "params": {"owner_id": user(i)},
+        },
+        "GET /api/todos/changes": lambda i: {
+            "method": "GET",
+            "url": "/api/todos/changes",
+            "params": {"user_id": user(i)},
+        },
+        "GET /api/todos/export": lambda i: {
+            "method": "GET",
+            "url": "/api/todos/export",
+            "params": {"user_id": user(i)},
+        },
+        "GET /api/todos/{id}": lambda i: {
+            "method": "GET",
+            "url": f"/api/todos/{todo(i)}",
+        },
+        "GET /api/users/": lambda i: {"method": "GET", "url": "/api/users/"},
+        "GET /api/users/crudmixin/": lambda i: {
+            "method": "GET",
+            "url": "/api/users/crudmixin/",
+        },
+        "GET /api/users/{id}": lambda i: {
+            "method": "GET",
+            "url": f"/api/users/{user(i)}",
+        },
+        "GET /api/users/{id}/stats": lambda i: {
+            "method": "GET",
+            "url": f"/api/users/{user(i)}/stats",
+        },
+        "GET /api/users/{id}/todos/export": lambda i: {
+            "method": "GET",
+            "url": f"/api/users/{user(i)}/todos/export",
+        },
+        "GET /api/users/crudmixin/{id}": lambda i: {
+            "method": "GET",
+            "url": f"/api/users/crudmixin/{user(i)}",
+        },
+        "GET /api/users/filter/": lambda i: {
+            "method": "GET",
+            "url": "/api/users/filter/",
+            "params": {"lname": f"Last{i % len(user_ids)}"},
+        },
+    }
+
+
+def write_scenarios(
+    user_ids: list, todo_ids: list, delete_ids: list, bulk_delete_ids: list
+) -> dict:
+    def user(i):
+        return user_ids[i % len(user_ids)]
+
+    def todo(i):
+        return todo_ids[i % len(todo_ids)]
+
+    def todo_body(i):
+        return {"owner_id": user(i), "text": f"bench todo {i}", "completed": False}
+
+    def import_body(i):
+        return "".join(json.dumps(todo_body(i * 100 + n)) + "\n" for n in range(100))
+
+    return {
+        "POST /api/todos/": lambda i: {
+            "method": "POST",
+            "url": "/api/todos/",
+            "json": todo_body(i),
+        },
+        "PUT /api/todos/{id}": lambda i: {
+            "method": "PUT",
+            "url": f"/api/todos/{todo(i)}",
+            "json": {**todo_body(i), "id": todo(i), "completed": i % 2 == 0},
+        },
+        "POST /api/todos/bulk": lambda i: {
+            "method": "POST",
+            "url": "/api/todos/bulk",
+            "json": [todo_body(i * 10 + n) for n in range(10)],
+        },
+        "PATCH /api/todos/bulk": lambda i: {
+            "method": "PATCH",
+            "url": "/api/todos/bulk",
+            "json": [
+                {**todo_body(n), "id": todo(i * 10 + n), "completed": True}
+                for n in range(10)
+            ],
+        },
+        "POST /api/todos/import": lambda i: {
+            "method": "POST",
+            "url": "/api/todos/import",
+            "content": import_body(i),
+            "headers": {"Content-Type": "application/x-ndjson"},
+        },
+        "DELETE /api/todos/{id}": lambda i: {
+            "method": "DELETE",
+            "url": f"/api/todos/{delete_ids[i]}",
+        },
+        "DELETE /api/todos/bulk": lambda i: {
+            "method": "DELETE",
+            "url": "/api/todos/bulk",
+            "json": bulk_delete_ids[i * 10 : i * 10 + 10],
+        },
+        "POST /api/users/signup/": lambda i: {
+            "method": "POST",
+            "url": "/api/users/signup/",
+            "json": {
+                "email": f"bench{i}-{time.time_ns()}@example.com",
+                "fname": "Bench",
+                "lname": "User",
+                "password": "secret",
+            },
+        },
+    }
+
+
+async def main(args):
+    print(
+        ">> seeding",
+        args.users,
+        "users x",
+        args.todos_per_user,
+        "todos",
+        file=sys.stderr,
+    )
+    await init_tables()
+    await seed_data(args.users, args.todos_per_user)
+    counter = QueryCounter()
+    report = {
+        "config": {
+            "users": args.users,
+            "todos_per_user": args.todos_per_user,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "database": engine.dialect.name,
+        },
+        "versions": {
+            "python": platform.python_version(),
+            "fastapi": fastapi.__version__,
+            "sqlalchemy": sqlalchemy.__version__,
+        },
+        "scenarios": {},
+    }
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark"
+        ) as client:
+            user_ids, todo_ids = await load_ids(args.requests)
+            delete_ids = await create_todo_ids(client, user_ids[0], args.requests)
+            bulk_delete_ids = await create_todo_ids(
+                client, user_ids[0], args.requests * 10
+            )
+            scenarios = itertools.chain(
+                read_scenarios(user_ids, todo_ids).items(),
+                write_scenarios(
+                    user_ids, todo_ids, delete_ids, bulk_delete_ids
+                ).items(),
+            )
+            for name, request in scenarios:
+                if args.only and not any(s in name for s in args.only):
+                    continue
+                print(">>", name, file=sys.stderr)
+                report["scenarios"][name] = await run_scenario(
+                    client, counter, request, args.requests, args.concurrency
+                )
+    finally:
+        await on_shutdown()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="api load test and benchmark")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--todos-per-user", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=200, help="per scenario")
+    parser.add_argument("--output", help="also write the json report to a file")
+    parser.add_argument(
+        "--only", nargs="*", help="run the scenarios whose name contains any of these"
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,103 @@
+# benchmark of todo list page serialization
+#
+# Compares the rows/sec of reading all todos in keyset pages, each page in
+# its own session as a request would:
+# - orm: `crud_todo.get_todos` ORM instances, serialized by FastAPI's own
+#   `serialize_response` with a `list[TodoRead]` response model and rendered
+#   by `JSONResponse`, as a route returning ORM instances does
+# - core: `crud_todo.get_todo_rows` Core rows, serialized by a prebuilt
+#   `TypeAdapter`, as on the `read_todos` fast path
+#
+# Run from the project root, the benchmark database is reset:
+#   python -m benchmarks.serialization --rows 20000 --limit 100
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+# use a separate database, `init_tables` drops all tables
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", "sqlite+aiosqlite:///./benchmark.db")
+
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_model_field  # noqa: E402
+
+from app import crud_todo, schemas  # noqa: E402
+from app.db import SessionLocal, dispose_engines  # noqa: E402
+from app.db_migration import init_tables, seed_data  # noqa: E402
+from app.pagination import next_cursor  # noqa: E402
+from app.serializers import ListSerializer  # noqa: E402
+
+todo_list = ListSerializer(schemas.TodoRead)
+
+
+async def seed(rows: int):
+    await init_tables()
+    await seed_data(users=10, todos_per_user=rows // 10)
+
+
+async def orm_page(limit: int, after: str | None):
+    field = create_model_field("Response", list[schemas.TodoRead])
+    async with SessionLocal() as db:
+        todos = await crud_todo.get_todos(db, limit=limit, after=after)
+        content = await serialize_response(field=field, response_content=todos)
+    JSONResponse(content).render(content)
+    return todos
+
+
+async def core_page(limit: int, after: str | None):
+    async with SessionLocal() as db:
+        rows = await crud_todo.get_todo_rows(
+            db, todo_list.columns, limit=limit, after=after
+        )
+    todo_list.response(rows)
+    return rows
+
+
+async def run(page, limit: int) -> dict:
+    count, pages, after = 0, 0, None
+    started = time.perf_counter()
+    while True:
+        rows = await page(limit, after)
+        count += len(rows)
+        pages += 1
+        after = next_cursor(rows, limit)
+        if not after:
+            break
+    elapsed = time.perf_counter() - started
+    return {
+        "rows": count,
+        "pages": pages,
+        "elapsed_seconds": round(elapsed, 3),
+        "rows_per_second": round(count / elapsed),
+    }
+
+
+async def main(rows: int, limit: int):
+    await seed(rows)
+    try:
+        # warm up connections and statement caches
+        await run(orm_page, limit)
+        await run(core_page, limit)
+        report = {
+            "rows": rows,
+            "limit": limit,
+            "orm": await run(orm_page, limit),
+            "core": await run(core_page, limit),
+        }
+    finally:
+        await dispose_engines()
+    report["speedup"] = round(
+        report["core"]["rows_per_second"] / report["orm"]["rows_per_second"], 2
+    )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="todo list serialization benchmark")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.limit))